@@ -0,0 +1,69 @@
+from collections import OrderedDict
+
+import google.generativeai as genai
+from google.generativeai.types.safety_types import HarmCategory, HarmBlockThreshold
+
+SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+}
+
+
+class Backend:
+    """Source of models for gemini_reply and gemini_blackjack.
+
+    ``get_model`` returns an object with the GenerativeModel interface used by the
+    bot: ``await model.generate_content_async(contents, stream=False)`` returning a
+    response with ``.text``, or with ``stream=True`` an async iterable of such chunks.
+    """
+
+    def get_model(self, model_name, system_instruction, api_key=None):
+        raise NotImplementedError
+
+
+class GeminiBackend(Backend):
+    # Models are keyed on (model name, system instruction, API key) so the persona prompt
+    # is baked in once and the per-message history travels as request content.
+    MODEL_CACHE_SIZE = 64
+
+    def __init__(self):
+        self.models = OrderedDict()
+
+    def get_model(self, model_name, system_instruction, api_key=None):
+        key = (model_name, system_instruction, api_key.index if api_key else None)
+        model = self.models.get(key)
+        if model is not None:
+            self.models.move_to_end(key)
+            return model
+
+        model = genai.GenerativeModel(model_name=model_name, safety_settings=SAFETY_SETTINGS,
+                                      system_instruction=system_instruction)
+        if api_key:
+            # GenerativeModel has no public way to pick a client, and genai.configure()
+            # is process-wide, so bind this key's client directly.
+            model._async_client = api_key.async_client()
+        self.models[key] = model
+        if len(self.models) > self.MODEL_CACHE_SIZE:
+            self.models.popitem(last=False)
+        return model
+
+
+backend = GeminiBackend()
+
+
+def configure_backend(name='gemini', options=None):
+    global backend
+    if name == 'gemini':
+        backend = GeminiBackend()
+    elif name == 'fake':
+        from AI.fake import FakeBackend
+        backend = FakeBackend(**(options or {}))
+    else:
+        raise ValueError(f"Unknown LLM backend: {name}")
+    return backend
+
+
+def get_model(model_name, system_instruction, api_key=None):
+    return backend.get_model(model_name, system_instruction, api_key)
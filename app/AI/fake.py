@@ -0,0 +1,121 @@
+import asyncio
+import itertools
+import random
+import re
+
+from google.api_core import exceptions as api_exceptions
+from google.generativeai.types import BlockedPromptException
+
+from AI.backend import Backend
+
+FAKE_REPLY = "This is a reply from the local stand-in model. " * 4
+
+# (pattern searched in the system instruction and request, replies used in turn)
+DEFAULT_SCRIPT = [
+    (r'"hit" or\s*"stand"', ["hit", "stand"]),
+    (r'how much you want to bet', ["100"]),
+    (r'amount of in-game currency', ["500"]),
+]
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self._text = text
+
+    @property
+    def text(self):
+        if not self._text:
+            # What the SDK does when the candidate has no text part
+            raise ValueError("Invalid operation: The `response.text` quick accessor requires the response to "
+                             "contain a valid `Part`, but none were returned.")
+        return self._text
+
+
+class FakeStream:
+    def __init__(self, text, chunk_size, chunk_delay):
+        self.chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+        self.chunk_delay = chunk_delay
+
+    async def __aiter__(self):
+        for index, chunk in enumerate(self.chunks):
+            if index:
+                await asyncio.sleep(self.chunk_delay)
+            yield FakeResponse(chunk)
+
+
+class FakeBackend(Backend):
+    """Offline stand-in for the Gemini API, for load and latency testing.
+
+    latency: ``{"dist": "fixed" | "uniform" | "lognormal", ...}`` with ``value``, ``low``/``high``
+        or ``median``/``sigma`` seconds, the response time (time to the first chunk when streaming).
+    errors: probability per request of ``"429"``, ``"500"``, ``"503"``, ``"safety"`` and ``"empty"``.
+    chunk_size, chunk_delay: how streamed replies are split and paced.
+    script: list of (regex, replies); the first pattern found in the prompt answers with its
+        replies in turn, anything else gets ``reply``.
+    """
+
+    def __init__(self, latency=None, errors=None, chunk_size=20, chunk_delay=0.05, script=None,
+                 reply=FAKE_REPLY, seed=None):
+        self.latency = latency or {"dist": "lognormal", "median": 1.0, "sigma": 0.4}
+        self.errors = errors or {}
+        self.chunk_size = chunk_size
+        self.chunk_delay = chunk_delay
+        self.script = [(re.compile(pattern), itertools.cycle(replies))
+                       for pattern, replies in (DEFAULT_SCRIPT if script is None else script)]
+        self.reply = reply
+        self.random = random.Random(seed)
+        self.requests = 0
+
+    def get_model(self, model_name, system_instruction, api_key=None):
+        return FakeGenerativeModel(self, model_name, system_instruction)
+
+    def sample_latency(self):
+        dist = self.latency.get("dist", "fixed")
+        if dist == "uniform":
+            return self.random.uniform(self.latency["low"], self.latency["high"])
+        if dist == "lognormal":
+            return self.random.lognormvariate(0, self.latency["sigma"]) * self.latency["median"]
+        return self.latency.get("value", 0.0)
+
+    def inject_error(self):
+        roll = self.random.random()
+        for kind, rate in self.errors.items():
+            if roll < rate:
+                return kind
+            roll -= rate
+        return None
+
+    def reply_for(self, prompt):
+        for pattern, replies in self.script:
+            if pattern.search(prompt):
+                return next(replies)
+        return self.reply
+
+
+class FakeGenerativeModel:
+    def __init__(self, backend, model_name, system_instruction=None):
+        self.backend = backend
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+
+    async def generate_content_async(self, contents, stream=False):
+        backend = self.backend
+        backend.requests += 1
+        await asyncio.sleep(backend.sample_latency())
+
+        error = backend.inject_error()
+        if error == "429":
+            raise api_exceptions.ResourceExhausted("Fake quota exceeded")
+        if error == "500":
+            raise api_exceptions.InternalServerError("Fake internal error")
+        if error == "503":
+            raise api_exceptions.ServiceUnavailable("Fake service unavailable")
+        if error == "safety":
+            raise BlockedPromptException("Fake blocked prompt")
+
+        prompt = self.system_instruction + "\n" + "\n".join(
+            part["text"] for content in contents for part in content["parts"])
+        text = "" if error == "empty" else backend.reply_for(prompt)
+        if stream:
+            return FakeStream(text, backend.chunk_size, backend.chunk_delay)
+        return FakeResponse(text)
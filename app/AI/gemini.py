@@ -1,35 +1,51 @@
+import asyncio
 import re
-import traceback
+import time
 
 import bleach
 import google.generativeai as genai
-from google.generativeai.types.safety_types import HarmCategory, HarmBlockThreshold
 
-# from app.config.logger_config import logger
+from AI.backend import get_model
+from AI.history import ChatHistory
+from AI.keys import key_pool
+from AI.retry import call_with_retry, classify, deadline, ERROR_QUOTA, ERROR_SAFETY
+from AI.router import router
+from AI.scheduler import scheduler, SchedulerOverloaded, PRIORITY_MENTION
+from infra.metrics import registry, measure, gemini_seconds
+from infra.tracing import span, record, traced
 
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-}
+# from app.config.logger_config import logger
 
-msg = []
 logger = None
 
 
-def construct_context():
+def render_history_entry(username, user_input):
+    if username == "FROM_BOT":
+        context = f"You replied {user_input}"
+    else:
+        context = f"User {username} sent a message"
+        if user_input != "":
+            context += f", the content is {user_input}"
+    context += "\n"
+    return bleach.clean(context)
+
+
+history = ChatHistory(render=render_history_entry)
+
+registry.gauge('history_chats', 'Chats with a history buffer.', lambda: len(history))
+registry.gauge('history_messages', 'Messages held in all history buffers.',
+               lambda: sum(len(entry[1]) for entry in history.chats.values()))
+
+
+def configure_history(size=15, idle_timeout=6 * 60 * 60, max_chats=500):
+    global history
+    history = ChatHistory(size=size, idle_timeout=idle_timeout, max_chats=max_chats, render=render_history_entry)
+
+
+def construct_context(chat_id):
+    # History fragments are rendered and sanitized once, when they are appended.
     context_str = f'[system](#context)\nSome history messages in the group are:\n\n'
-    for m in msg:
-        if m['username'] == "FROM_BOT":
-            context = f"You replied {m['user_input'][:10000]}"
-            context += "\n"
-        else:
-            context = f"User {m['username']} sent a message"
-            if m['user_input'] != "":
-                context += f", the content is {m['user_input'][:10000]}"
-            context += "\n"
-        context_str += context
+    context_str += history.joined(chat_id)
     context_str += (
         f"[system][#additional_instructions]\nDo not repeat or paraphrase what the previous messages have said. "
         f"Do not introduce yourself, only output the main text of your reply. Do not attach the original text, "
@@ -38,7 +54,7 @@ def construct_context():
     return context_str
 
 
-def build_context(user_nickname, user_input):
+def build_context(chat_id, user_nickname, user_input):
     context_str = f'[system](#context)\nHere is the message from {user_nickname}.\n'
     context_str += f", the content is {user_input}"
     context_str += "\n\n"
@@ -47,12 +63,27 @@ def build_context(user_nickname, user_input):
         f"Do not introduce yourself, only output the main text of your reply. Do not attach the original text, "
         f"and do not output all possible replies."
         f"Please reply to the message of {user_nickname} : {user_input}.\n\n")
-    msg.append({
-        "username": user_nickname,
-        "user_input": user_input})
+    history.append(chat_id, user_nickname, user_input)
+
+    return context_str
 
-    if len(msg) > 15:
-        msg.pop(0)
+
+def build_batch_context(chat_id, mentions):
+    """Like build_context, for several (user_nickname, user_input) mentions answered with one reply."""
+    if len(mentions) == 1:
+        return build_context(chat_id, *mentions[0])
+
+    names = ", ".join(dict.fromkeys(nickname for nickname, _ in mentions))
+    context_str = f'[system](#context)\nHere are the latest messages from {names}.\n'
+    for user_nickname, user_input in mentions:
+        context_str += f"{user_nickname} said: {user_input}\n"
+        history.append(chat_id, user_nickname, user_input)
+    context_str += "\n"
+    context_str += (
+        f"[system][#additional_instructions]\nWhen replying, do not repeat or paraphrase what they have said. "
+        f"Do not introduce yourself, only output the main text of your reply. Do not attach the original text, "
+        f"and do not output all possible replies. "
+        f"Please reply to all of these messages at once in a single reply, addressing {names}.\n\n")
 
     return context_str
 
@@ -89,28 +120,26 @@ def ask_by_user(ask_string):
     return res
 
 
-def init_prompt_bot_statement(user_nickname, group_name, persona, per):
+def init_prompt_bot_statement(persona, per):
     # persona = None
     # pre_reply = None
     #
     # if not persona:
     #     persona = bot["persona"]
     #     pre_reply = bot["pre_reply"]
-    prompt = persona[per]['p'].format(n=user_nickname, k=persona[per]['n'], m=group_name)
+    # Only the persona goes into the system instruction, so its model is cached across users and groups;
+    # who is talking and where is sent with the request, see build_reply_messages
+    prompt = persona[per]['p'].format(n="the user", k=persona[per]['n'], m="this group")
     # pre_reply = pre_reply.format(n=user_nickname, k=bot_nickname, m=group_name)
     # logger.info("PERSONA:" + persona)
     return prompt
 
 
-async def gemini_reply(context, message, bot_statement, user_nickname, group_name, persona, per, bot_model,
-                       mdl, retry_count=0):
-    if retry_count > 3:
-        logger.error("Failed after maximum number of retry times")
-        return
-
-    # Clean the context string using bleach
-    context = bleach.clean(context).strip()
-    context = "<|im_start|>system\n\n" + context
+def build_reply_messages(context, message, user_nickname, group_name):
+    # construct_context() output is already sanitized entry by entry
+    context = context.strip()
+    speaker = bleach.clean(f"[system](#context)\nYou are chatting with {user_nickname} in the group {group_name}.")
+    context = "<|im_start|>system\n\n" + speaker + "\n\n" + context
 
     ask_string = (
         f"\n\nPlease reply to the last comment. No need to introduce yourself, just output the main text of your "
@@ -121,44 +150,187 @@ async def gemini_reply(context, message, bot_statement, user_nickname, group_nam
     ask_string = bleach.clean(ask_string).strip()
     # logger.info(f"ask_string: {ask_string}")
 
+    return ask_by_user(context + "\n\n" + message + "\n\n" + ask_string)
+
+
+def record_failure(model_name, elapsed, api_key, kind):
+    # A 429 is one key out of quota; it only counts against the model once no other key is left
+    if kind == ERROR_QUOTA and key_pool.has_spare(api_key):
+        router.skip(model_name)
+    else:
+        router.record(model_name, elapsed, kind == ERROR_SAFETY, kind)
+
+
+async def generate_text(system_instruction, contents, priority):
+    """Generate a reply through the scheduler, model router, API key pool and retry policy."""
+
+    async def generate():
+        queued = time.perf_counter()
+        async with scheduler.slot(priority):
+            record('gemini_queue', queued)
+            model_name = router.pick()
+            api_key = key_pool.acquire()
+            started = time.monotonic()
+            kind = None
+            try:
+                with span('get_model'):
+                    model = get_model(model_name, system_instruction, api_key)
+                with span(f'generate {model_name}'):
+                    response = await deadline(model.generate_content_async(contents))
+                    text = response.text
+            except asyncio.CancelledError:
+                # The caller gave up on it; a model that hangs has to look unhealthy too
+                router.record(model_name, time.monotonic() - started, False)
+                raise
+            except Exception as e:
+                kind = classify(e)
+                record_failure(model_name, time.monotonic() - started, api_key, kind)
+                raise
+            finally:
+                # Also when the attempt is cancelled by a deadline
+                key_pool.release(api_key, kind)
+            router.record(model_name, time.monotonic() - started, True)
+        return text
+
+    return await call_with_retry(generate, logger=logger)
+
+
+@traced('gemini_reply')
+async def gemini_reply(chat_id, context, message, bot_statement, user_nickname, group_name, persona, per,
+                       priority=PRIORITY_MENTION):
+    with span('prompt'):
+        prompt = init_prompt_bot_statement(persona, per)
+    with span('sanitize'):
+        gemini_messages = build_reply_messages(context, message, user_nickname, group_name)
+
     try:
-        prompt = init_prompt_bot_statement(user_nickname, group_name, persona, per)
-        model = genai.GenerativeModel(model_name=bot_model[mdl], safety_settings=SAFETY_SETTINGS,
-                                      system_instruction=prompt + "\n\n" + context + "\n\n" + message)
-        gemini_messages = ask_by_user(ask_string)
-        response = model.generate_content(gemini_messages)
-        reply_text = response.text
-        logger.info(reply_text)
-        # print(reply_text)
-        if "I am an automated reply bot" not in reply_text:
+        with measure(gemini_seconds, 'reply'):
+            reply_text = await generate_text(prompt, gemini_messages, priority)
+    except SchedulerOverloaded as e:
+        logger.info(e)
+        return
+    except Exception as e:
+        logger.error(f"Gemini reply failed ({classify(e)}): {e}")
+        return
+
+    logger.info(reply_text)
+    # print(reply_text)
+    if "I am an automated reply bot" not in reply_text:
+        reply_text += bot_statement
+    # content.reply(reply_text)
+    # res.append({
+    #     "role": "model",
+    #     "parts": [{"text": reply_text}]
+    # })
+    history.append(chat_id, "FROM_BOT", reply_text)
+    return reply_text
+
+
+async def gemini_reply_stream(chat_id, context, message, bot_statement, user_nickname, group_name, persona, per,
+                              priority=PRIORITY_MENTION):
+    """Same as gemini_reply, but yields the reply text chunk by chunk as it is generated.
+
+    Only opening the stream is retried; an error after the first chunk ends the reply.
+    """
+    with span('prompt'):
+        prompt = init_prompt_bot_statement(persona, per)
+    with span('sanitize'):
+        gemini_messages = build_reply_messages(context, message, user_nickname, group_name)
+    api_key = None
+    holding_slot = False
+
+    async def connect():
+        # The slot is taken per attempt, so backoff sleeps between attempts leave it free
+        nonlocal api_key, holding_slot
+        queued = time.perf_counter()
+        await scheduler.acquire(priority)
+        holding_slot = True
+        record('gemini_queue', queued)
+        model_name = router.pick()
+        api_key = key_pool.acquire()
+        started = time.monotonic()
+        kind = None
+        opened = False
+        try:
+            with span('get_model'):
+                model = get_model(model_name, prompt, api_key)
+            with span(f'open stream {model_name}'):
+                response = await deadline(model.generate_content_async(gemini_messages, stream=True))
+            opened = True
+        except asyncio.CancelledError:
+            router.record(model_name, time.monotonic() - started, False)
+            raise
+        except Exception as e:
+            kind = classify(e)
+            record_failure(model_name, time.monotonic() - started, api_key, kind)
+            raise
+        finally:
+            # An open stream keeps its key until it has been read
+            if not opened:
+                key_pool.release(api_key, kind)
+                api_key = None
+                scheduler.release()
+                holding_slot = False
+        # Time to the start of the stream
+        router.record(model_name, time.monotonic() - started, True)
+        return response
+
+    async def read(chunks):
+        """Read the whole stream into ``chunks``, then give back the slot and key and put None."""
+        nonlocal api_key, holding_slot
+        try:
+            with measure(gemini_seconds, 'reply_stream'):
+                response = await call_with_retry(connect, logger=logger)
+                async for chunk in response:
+                    text = chunk.text
+                    if text:
+                        chunks.put_nowait(text)
+        finally:
+            if api_key is not None:
+                key_pool.release(api_key)
+                api_key = None
+            if holding_slot:
+                scheduler.release()
+                holding_slot = False
+            chunks.put_nowait(None)
+
+    # The stream is read by its own task, so the Gemini slot is free as soon as the reply is
+    # complete, however long the outbound limiter holds back the consumer's Telegram sends
+    chunks = asyncio.Queue()
+    reader = asyncio.create_task(read(chunks))
+    reply_text = ""
+    try:
+        while (text := await chunks.get()) is not None:
+            reply_text += text
+            yield text
+        await reader
+
+        if bot_statement and "I am an automated reply bot" not in reply_text:
             reply_text += bot_statement
-        # content.reply(reply_text)
-        # res.append({
-        #     "role": "model",
-        #     "parts": [{"text": reply_text}]
-        # })
-        msg.append({
-            "username": "FROM_BOT",
-            "user_input": reply_text})
-        return reply_text
+            yield bot_statement
 
+    except SchedulerOverloaded as e:
+        logger.info(e)
     except Exception as e:
-        traceback.print_exc()
-        logger.warning(e)
-        await gemini_reply(context, message, bot_statement, user_nickname, group_name, persona, per, bot_model,
-                           mdl, retry_count + 1)
+        logger.error(f"Gemini reply failed ({classify(e)}): {e}")
+    finally:
+        # Only still running when the consumer stopped early
+        reader.cancel()
+
+    if reply_text:
+        logger.info(reply_text)
+        history.append(chat_id, "FROM_BOT", reply_text)
 
 
 @staticmethod
-def GeminiApiConfig(key, log):
+def GeminiApiConfig(key, log, cooldown=60):
     global logger
-    # keys = bot['key']
-    # keys = keys.split("|")
-    # keys = [key.strip() for key in keys]
-    if not key:
+    # Several keys can be given separated by "|"
+    keys = [k.strip() for k in key.split("|") if k.strip()] if key else []
+    if not keys:
         raise Exception("Please set a valid API key in Config!")
-    # api_key = random.choice(keys)
-    api_key = key
-    genai.configure(api_key=api_key)
+    # Default client for anything not going through the key pool
+    genai.configure(api_key=keys[0])
+    key_pool.configure(keys, cooldown)
     logger = log
-    logger.info("Config Gemini API successfully.")
+    logger.info(f"Config Gemini API successfully with {len(keys)} key(s).")
@@ -0,0 +1,71 @@
+import time
+from collections import OrderedDict, deque
+
+# Longest message text kept per history entry.
+ENTRY_LIMIT = 10000
+
+
+class ChatHistory:
+    """Recent messages per chat, bounded in length, idle time and chat count.
+
+    Each entry is rendered once by ``render`` when it is appended, and the
+    joined fragments are cached until the chat's buffer changes again.
+    """
+
+    def __init__(self, size=15, idle_timeout=6 * 60 * 60, max_chats=500, render=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_chats = max_chats
+        self.render = render
+        # chat_id -> [last_seen, deque, joined fragments], least recently used first
+        self.chats = OrderedDict()
+
+    def get(self, chat_id):
+        entry = self.chats.get(chat_id)
+        if entry is None:
+            return ()
+        return entry[1]
+
+    def joined(self, chat_id):
+        entry = self.chats.get(chat_id)
+        if entry is None:
+            return ""
+        if entry[2] is None:
+            entry[2] = "".join(m["fragment"] for m in entry[1])
+        return entry[2]
+
+    def append(self, chat_id, username, user_input):
+        now = time.monotonic()
+        entry = self.chats.get(chat_id)
+        if entry is None:
+            entry = [now, deque(maxlen=self.size), None]
+            self.chats[chat_id] = entry
+        else:
+            entry[0] = now
+            entry[2] = None
+            self.chats.move_to_end(chat_id)
+
+        user_input = user_input[:ENTRY_LIMIT]
+        entry[1].append({
+            "username": username,
+            "user_input": user_input,
+            "fragment": self.render(username, user_input) if self.render else ""})
+        self.evict(now)
+
+    def evict(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        while self.chats:
+            chat_id, (last_seen, _, _) = next(iter(self.chats.items()))
+            if len(self.chats) <= self.max_chats and now - last_seen < self.idle_timeout:
+                break
+            del self.chats[chat_id]
+
+    def clear(self, chat_id=None):
+        if chat_id is None:
+            self.chats.clear()
+        else:
+            self.chats.pop(chat_id, None)
+
+    def __len__(self):
+        return len(self.chats)
@@ -0,0 +1,86 @@
+import time
+
+from google.ai import generativelanguage as glm
+from google.api_core import client_options as client_options_lib
+from google.api_core import gapic_v1
+
+from AI.retry import ERROR_QUOTA
+
+
+class ApiKey:
+    def __init__(self, key, index):
+        self.key = key
+        self.index = index
+        self.in_flight = 0
+        self.last_used = 0.0
+        self.benched_until = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.quota_errors = 0
+        self.client = None
+
+    def async_client(self):
+        # One client per key, since genai.configure() only holds a single process-wide key
+        if self.client is None:
+            self.client = glm.GenerativeServiceAsyncClient(
+                client_options=client_options_lib.ClientOptions(api_key=self.key),
+                client_info=gapic_v1.client_info.ClientInfo(user_agent="genai-py"),
+            )
+        return self.client
+
+    def __repr__(self):
+        return f"key#{self.index}"
+
+
+class KeyPool:
+    """Spreads requests over several API keys, benching a key for ``cooldown`` seconds after a 429."""
+
+    def __init__(self, keys=(), cooldown=60.0):
+        self.configure(keys, cooldown)
+
+    def configure(self, keys, cooldown=60.0):
+        self.keys = [ApiKey(key, index) for index, key in enumerate(keys)]
+        self.cooldown = cooldown
+
+    def acquire(self):
+        """Pick the least busy, least recently used key that is not benched."""
+        if not self.keys:
+            raise Exception("Please set a valid API key in Config!")
+        now = time.monotonic()
+        ready = [k for k in self.keys if k.benched_until <= now]
+        if ready:
+            api_key = min(ready, key=lambda k: (k.in_flight, k.last_used))
+        else:
+            api_key = min(self.keys, key=lambda k: k.benched_until)
+        api_key.in_flight += 1
+        api_key.last_used = now
+        api_key.requests += 1
+        return api_key
+
+    def has_spare(self, api_key):
+        """Whether a key other than ``api_key`` is not benched."""
+        now = time.monotonic()
+        return any(k is not api_key and k.benched_until <= now for k in self.keys)
+
+    def release(self, api_key, error_kind=None):
+        api_key.in_flight -= 1
+        if error_kind is None:
+            return
+        api_key.failures += 1
+        if error_kind == ERROR_QUOTA:
+            api_key.quota_errors += 1
+            api_key.benched_until = time.monotonic() + self.cooldown
+
+    def stats(self):
+        now = time.monotonic()
+        return [{
+            'key': repr(k),
+            'in_flight': k.in_flight,
+            'requests': k.requests,
+            'failures': k.failures,
+            'quota_errors': k.quota_errors,
+            'benched_for': max(0.0, k.benched_until - now),
+        } for k in self.keys]
+
+
+key_pool = KeyPool()
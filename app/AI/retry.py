@@ -0,0 +1,164 @@
+import asyncio
+import random
+import time
+
+from google.api_core import exceptions as api_exceptions
+from google.generativeai.types import BlockedPromptException, StopCandidateException
+
+ERROR_QUOTA = 'quota'
+ERROR_TRANSIENT = 'transient'
+ERROR_SAFETY = 'safety'
+ERROR_FATAL = 'fatal'
+
+RETRYABLE = (ERROR_QUOTA, ERROR_TRANSIENT)
+
+TRANSIENT_ERRORS = (
+    api_exceptions.ServiceUnavailable,
+    api_exceptions.InternalServerError,
+    api_exceptions.DeadlineExceeded,
+    api_exceptions.BadGateway,
+    api_exceptions.GatewayTimeout,
+    asyncio.TimeoutError,
+    ConnectionError,
+)
+
+
+class LocalError(Exception):
+    """Raised before a request reaches the API, so it is neither retried nor counted by the breaker."""
+
+
+class CircuitOpen(LocalError):
+    """Raised without calling the API while the circuit breaker is open."""
+
+
+def classify(error):
+    """Sort a Gemini error into quota, transient, safety or fatal."""
+    if isinstance(error, (BlockedPromptException, StopCandidateException)):
+        return ERROR_SAFETY
+    # Anything exposing an HTTP status code, including api_core errors
+    code = getattr(error, 'code', None)
+    if isinstance(error, api_exceptions.ResourceExhausted) or code == 429:
+        return ERROR_QUOTA
+    if isinstance(error, TRANSIENT_ERRORS) or code in (500, 502, 503, 504):
+        return ERROR_TRANSIENT
+    if isinstance(error, ValueError):
+        # response.text raises ValueError when the candidate was blocked or empty
+        return ERROR_SAFETY
+    return ERROR_FATAL
+
+
+class RetryPolicy:
+    def __init__(self, attempts=4, base_delay=1.0, quota_delay=5.0, max_delay=30.0, attempt_timeout=60.0):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.quota_delay = quota_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+
+    def backoff(self, attempt, kind):
+        """Full jitter exponential backoff before retry number ``attempt`` (starting at 1)."""
+        base = self.quota_delay if kind == ERROR_QUOTA else self.base_delay
+        return random.uniform(0, min(self.max_delay, base * 2 ** (attempt - 1)))
+
+
+class CircuitBreaker:
+    """Opens after ``threshold`` consecutive retryable failures and lets one probe through after ``reset_timeout``."""
+
+    def __init__(self, threshold=5, reset_timeout=30.0, name="Gemini API"):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if self.probing or time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def available(self):
+        """Whether ``before`` would let a request through."""
+        state = self.state
+        return state == 'closed' or (state == 'half-open' and not self.probing)
+
+    def before(self):
+        if not self.available():
+            raise CircuitOpen(f"{self.name} circuit is open, failing fast")
+        if self.state == 'half-open':
+            self.probing = True
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def ignore(self):
+        """Forget a request that says nothing about the service, so a half-open breaker can probe again."""
+        self.probing = False
+
+    def failure(self, kind):
+        if kind not in RETRYABLE:
+            # The API answered, it just refused this request
+            self.probing = False
+            return
+        self.failures += 1
+        if self.probing or self.failures >= self.threshold:
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+
+default_policy = RetryPolicy()
+
+
+def configure_retry(attempts=4, attempt_timeout=60.0):
+    default_policy.attempts = attempts
+    default_policy.attempt_timeout = attempt_timeout
+
+
+def deadline(awaitable, policy=None):
+    """Bound one API request by the attempt timeout.
+
+    Applied by the attempt itself around the request only, so time spent waiting for a
+    local scheduler slot is not taken for an API timeout.
+    """
+    return asyncio.wait_for(awaitable, (policy or default_policy).attempt_timeout)
+
+
+async def call_with_retry(call, policy=None, breaker=None, logger=None):
+    """Await ``call()`` until it succeeds, retrying quota and transient errors with backoff.
+
+    Safety blocks, fatal errors and LocalErrors are raised immediately, as is CircuitOpen
+    while ``breaker`` is open. ``call`` bounds its request with ``deadline``. Gemini calls
+    pass no breaker: the router keeps one per model, see ``ModelRouter.record``.
+    """
+    policy = policy or default_policy
+
+    attempt = 1
+    while True:
+        if breaker:
+            breaker.before()
+        try:
+            result = await call()
+        except LocalError:
+            if breaker:
+                breaker.failure(None)
+            raise
+        except Exception as e:
+            kind = classify(e)
+            if breaker:
+                breaker.failure(kind)
+            if kind not in RETRYABLE or attempt >= policy.attempts:
+                raise
+            delay = policy.backoff(attempt, kind)
+            if logger:
+                logger.warning(f"Gemini {kind} error on attempt {attempt}, retrying in {delay:.1f}s: {e}")
+            await asyncio.sleep(delay)
+            attempt += 1
+        else:
+            if breaker:
+                breaker.success()
+            return result
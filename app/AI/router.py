@@ -0,0 +1,140 @@
+import time
+from collections import deque
+
+from AI.retry import CircuitBreaker
+
+
+class ModelStats:
+    def __init__(self, name, window, breaker):
+        self.name = name
+        self.breaker = breaker
+        # (finished_at, latency, ok) of the most recent requests
+        self.samples = deque(maxlen=window)
+        self.routed = 0
+
+    def record(self, latency, ok):
+        self.samples.append((time.monotonic(), latency, ok))
+
+    def p95(self):
+        latencies = sorted(latency for _, latency, ok in self.samples if ok)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+
+    def error_rate(self):
+        if not self.samples:
+            return 0.0
+        return sum(1 for _, _, ok in self.samples if not ok) / len(self.samples)
+
+
+class ModelRouter:
+    """Sends requests to the first healthy model of the configured list.
+
+    A model is unhealthy while its rolling p95 latency or error rate is over the
+    threshold, or while its own circuit breaker is open; after ``recheck`` seconds on a
+    fallback the primary gets traffic again so its stats can recover. Only when every
+    model's breaker is open do requests fail fast with CircuitOpen.
+    """
+
+    def __init__(self, models=(), max_p95=20.0, max_error_rate=0.5, window=50, min_samples=5, recheck=60.0,
+                 breaker_threshold=5, breaker_reset=30.0):
+        self.max_p95 = max_p95
+        self.max_error_rate = max_error_rate
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        self.min_samples = min_samples
+        self.recheck = recheck
+        self.window = window
+        self.configure(models)
+
+    def configure(self, models, max_p95=None, max_error_rate=None, breaker_threshold=None, breaker_reset=None):
+        if max_p95 is not None:
+            self.max_p95 = max_p95
+        if max_error_rate is not None:
+            self.max_error_rate = max_error_rate
+        if breaker_threshold is not None:
+            self.breaker_threshold = breaker_threshold
+        if breaker_reset is not None:
+            self.breaker_reset = breaker_reset
+        if isinstance(models, str):
+            models = [models]
+        self.models = [ModelStats(name, self.window,
+                                  CircuitBreaker(self.breaker_threshold, self.breaker_reset, name))
+                       for name in models]
+        self.current = 0
+        self.switched_at = time.monotonic()
+        # (wall clock, from model, to model, reason) of the latest switches
+        self.decisions = deque(maxlen=10)
+
+    def healthy(self, stats):
+        if not stats.breaker.available():
+            return False
+        if len(stats.samples) < self.min_samples:
+            return True
+        return stats.p95() <= self.max_p95 and stats.error_rate() <= self.max_error_rate
+
+    def pick(self):
+        if not self.models:
+            raise Exception("No Gemini model configured!")
+        if self.current and time.monotonic() - self.switched_at >= self.recheck:
+            # Give the models ahead of the fallback a fresh start
+            for stats in self.models[:self.current]:
+                stats.samples.clear()
+
+        chosen = next((i for i, stats in enumerate(self.models) if self.healthy(stats)), len(self.models) - 1)
+        if chosen != self.current:
+            previous = self.models[self.current]
+            if chosen > self.current:
+                reason = f"p95 {previous.p95():.1f}s, error rate {previous.error_rate():.0%}"
+                if not previous.breaker.available():
+                    reason += ", circuit open"
+            else:
+                reason = "rechecking"
+            self.decisions.append((time.time(), previous.name, self.models[chosen].name, reason))
+            self.current = chosen
+            self.switched_at = time.monotonic()
+        stats = self.models[chosen]
+        # Raises CircuitOpen when even the last model is failing
+        stats.breaker.before()
+        stats.routed += 1
+        return stats.name
+
+    def record(self, name, latency, ok, kind=None):
+        """Add a request to the model's stats; ``kind`` is the classified error, if any.
+
+        A cancelled request is recorded as not ``ok`` without a kind: it counts against the
+        model's error rate but not its breaker.
+        """
+        for stats in self.models:
+            if stats.name == name:
+                stats.record(latency, ok)
+                if ok and kind is None:
+                    stats.breaker.success()
+                else:
+                    stats.breaker.failure(kind)
+                return
+
+    def skip(self, name):
+        """Leave a request out of the model's stats and breaker, like a 429 of one of several API keys."""
+        for stats in self.models:
+            if stats.name == name:
+                stats.breaker.ignore()
+                return
+
+    def stats(self):
+        return {
+            'current': self.models[self.current].name if self.models else None,
+            'models': [{
+                'model': stats.name,
+                'routed': stats.routed,
+                'samples': len(stats.samples),
+                'p95': stats.p95(),
+                'error_rate': stats.error_rate(),
+                'healthy': self.healthy(stats),
+                'breaker': stats.breaker.state,
+            } for stats in self.models],
+            'decisions': list(self.decisions),
+        }
+
+
+router = ModelRouter()
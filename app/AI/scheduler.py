@@ -0,0 +1,130 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+from AI.retry import LocalError
+
+# Lower value is served first.
+PRIORITY_GAME = 0
+PRIORITY_MENTION = 1
+PRIORITY_AMBIENT = 2
+
+PRIORITY_NAMES = {
+    PRIORITY_GAME: 'game',
+    PRIORITY_MENTION: 'mention',
+    PRIORITY_AMBIENT: 'ambient',
+}
+
+
+class SchedulerOverloaded(LocalError):
+    """Raised when a low priority request is dropped because the queue is too deep."""
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self):
+        """Take a token and return 0, or return the seconds until one is available."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class GeminiScheduler:
+    """Admits Gemini requests by priority, under a concurrency limit and a requests-per-minute budget."""
+
+    def __init__(self, max_in_flight=4, rpm=60, shed_depth=10):
+        self.configure(max_in_flight, rpm, shed_depth)
+        self.in_flight = 0
+        self.queue = []
+        # Requests still waiting in queue; cancelled ones stay in the heap until they surface
+        self.waiting = 0
+        self.counter = itertools.count()
+        self.timer = None
+        self.waits = deque(maxlen=200)
+        self.served = dict.fromkeys(PRIORITY_NAMES, 0)
+        self.shed = 0
+
+    def configure(self, max_in_flight=4, rpm=60, shed_depth=10):
+        self.max_in_flight = max_in_flight
+        self.bucket = TokenBucket(rpm / 60, max(1, max_in_flight))
+        self.shed_depth = shed_depth
+
+    @asynccontextmanager
+    async def slot(self, priority):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def acquire(self, priority):
+        if priority >= PRIORITY_AMBIENT and self.waiting >= self.shed_depth:
+            self.shed += 1
+            raise SchedulerOverloaded(f"Gemini queue is {self.waiting} deep, dropping request")
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queue, (priority, next(self.counter), time.monotonic(), future))
+        self.waiting += 1
+        self.dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted just before being cancelled, give the slot back
+                self.release()
+            elif len(self.queue) > 2 * self.waiting:
+                # Drop cancelled entries once they outnumber the live ones
+                self.queue = [entry for entry in self.queue if not entry[3].cancelled()]
+                heapq.heapify(self.queue)
+            raise
+        finally:
+            self.waiting -= 1
+        self.served[priority] += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self.dispatch()
+
+    def dispatch(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        while self.queue and self.in_flight < self.max_in_flight:
+            if self.queue[0][3].cancelled():
+                heapq.heappop(self.queue)
+                continue
+            delay = self.bucket.take()
+            if delay:
+                self.timer = asyncio.get_running_loop().call_later(delay, self.dispatch)
+                return
+            _, _, queued_at, future = heapq.heappop(self.queue)
+            self.in_flight += 1
+            self.waits.append(time.monotonic() - queued_at)
+            future.set_result(None)
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            'queue_depth': self.waiting,
+            'in_flight': self.in_flight,
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+            'served': {PRIORITY_NAMES[p]: n for p, n in self.served.items()},
+            'shed': self.shed,
+        }
+
+
+scheduler = GeminiScheduler()
@@ -1,19 +1,38 @@
 import asyncio
+import multiprocessing
+import os
 import random
+import secrets
 import sys
+import tempfile
+import time
 import traceback
 
-from telegram import (Update, InlineKeyboardButton, InlineKeyboardMarkup)
-from telegram.error import TelegramError
+from telegram import (Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup)
+from telegram.error import TelegramError, RetryAfter
 from telegram.ext import (Application, CommandHandler,
                           ContextTypes, MessageHandler, filters, ConversationHandler, CallbackQueryHandler)
 
-from game.blackjack import (insurance_handler, start, join, action_handler, bet_callback_handler, load_balances, add_balance,save_balances)
+from game.blackjack import (insurance_handler, start, join, action_handler, bet_callback_handler, load_balances, add_balance,save_balances,
+                            configure_ai, schedule_flush, restore_games)
 from config.config import bot
-from AI.gemini import (GeminiApiConfig, gemini_reply, construct_context, build_context)
-from app.config.logger_config import logger, setup_logger, log_message
+from AI.gemini import (GeminiApiConfig, gemini_reply, gemini_reply_stream, construct_context, build_context,
+                       build_batch_context, configure_history)
+from AI.scheduler import scheduler, PRIORITY_MENTION, PRIORITY_AMBIENT, PRIORITY_NAMES
+from AI.retry import configure_retry
+from AI.keys import key_pool
+from AI.router import router
+from AI.backend import configure_backend
+from infra.ratelimit import limiter
+from infra.coalesce import edits
+from infra.shard import Dispatcher, HashRing, serve_worker, socket_path
+from infra.metrics import registry, timed, handler_seconds, replies
+from infra.tracing import tracer, traced, span
+from app.config.logger_config import logger, setup_logger, log_message, listen
 
 log = ''
+# Set in worker processes, which log through the dispatcher's queue
+log_queue = None
 bot_token = ''
 admin = ''
 key = ''
@@ -21,9 +40,14 @@ bot_nickname = []
 groups = []
 persona = []
 bot_model = []
+stream = False
+stream_interval = 1.5
+coalesce_window = 0
+
+# chat_id -> [(user_nickname, user_input, message_id)] waiting for the coalescing window to close
+pending_mentions = {}
 
 per = 0
-mdl = 0
 
 SPE = range(1)
 
@@ -37,6 +61,9 @@ def load_config():
     global bot_nickname
     global groups
     global bot_model
+    global stream
+    global stream_interval
+    global coalesce_window
 
     required_keys = ['log', 'bot_token', 'persona', 'key', 'admin', 'bot_nickname', 'groups', 'model']
 
@@ -53,14 +80,143 @@ def load_config():
     bot_nickname = bot['bot_nickname']
     groups = bot['groups']
     bot_model = bot['model']
+    stream = bot.get('stream', False)
+    stream_interval = bot.get('stream_interval', 1.5)
+    coalesce_window = bot.get('coalesce_window', 0)
+    router.configure(
+        bot_model,
+        max_p95=bot.get('model_max_p95', 20),
+        max_error_rate=bot.get('model_max_error_rate', 0.5),
+        breaker_threshold=bot.get('gemini_breaker_threshold', 5),
+        breaker_reset=bot.get('gemini_breaker_reset', 30)
+    )
+    scheduler.configure(
+        max_in_flight=bot.get('gemini_concurrency', 4),
+        rpm=bot.get('gemini_rpm', 60),
+        shed_depth=bot.get('gemini_shed_depth', 10)
+    )
+    configure_retry(
+        attempts=bot.get('gemini_retries', 4),
+        attempt_timeout=bot.get('gemini_timeout', 60)
+    )
 
-    setup_logger(log)
-    GeminiApiConfig(key, logger)
-    load_balances(logger)
+    setup_logger(
+        log,
+        max_bytes=bot.get('log_max_bytes', 1024 * 1024),
+        backups=bot.get('log_backups', 2),
+        fmt=bot.get('log_format', 'text'),
+        use_queue=bot.get('log_queue', True),
+        log_queue=log_queue
+    )
+    edits.configure(window=bot.get('edit_window', 0.5), logger=logger)
+    tracer.configure(
+        slow=bot.get('trace_slow', 5),
+        size=bot.get('trace_buffer', 200),
+        path=bot.get('trace_file'),
+        logger=logger
+    )
+    limiter.configure(
+        global_rate=bot.get('telegram_rate', 30),
+        group_rpm=bot.get('telegram_group_rpm', 20),
+        private_rate=bot.get('telegram_private_rate', 1),
+        max_retries=bot.get('telegram_retries', 3)
+    )
+    GeminiApiConfig(key, logger, cooldown=bot.get('key_cooldown', 60))
+    configure_backend(bot.get('backend', 'gemini'), bot.get('fake_backend'))
+    configure_history(
+        size=bot.get('history_size', 15),
+        idle_timeout=bot.get('history_idle', 6 * 60 * 60),
+        max_chats=bot.get('history_chats', 500)
+    )
+    configure_ai(bot.get('blackjack_ai', 'llm-with-strategy-fallback-on-timeout'), bot.get('blackjack_ai_timeout', 3))
+    load_balances(logger, bot.get('balance_db', './app/data/balances.db'),
+                  flush_interval=bot.get('balance_flush_interval', 5))
 
     logger.info("Loading config successfully.")
 
 
+async def send_stream_reply(context: ContextTypes.DEFAULT_TYPE, chat_id, reply_to_id, chunks):
+    """Send the first streamed chunk as a new message, then edit it at most once per stream_interval."""
+    loop = asyncio.get_running_loop()
+    text = ""
+    shown = ""
+    sent = None
+    last_edit = 0.0
+
+    async for chunk in chunks:
+        text += chunk
+        if not text.strip():
+            continue
+        if sent is None:
+            sent = await context.bot.send_message(
+                chat_id=chat_id,
+                text=text,
+                reply_to_message_id=reply_to_id
+            )
+            shown = text
+            last_edit = loop.time()
+        elif loop.time() - last_edit >= stream_interval:
+            await context.bot.edit_message_text(chat_id=chat_id, message_id=sent.message_id, text=text)
+            shown = text
+            last_edit = loop.time()
+
+    if sent is not None and text != shown:
+        await context.bot.edit_message_text(chat_id=chat_id, message_id=sent.message_id, text=text)
+    return sent
+
+
+async def send_gemini_reply(context: ContextTypes.DEFAULT_TYPE, chat_id, reply_to_id, prompt_context, **request):
+    if stream:
+        chunks = gemini_reply_stream(chat_id=chat_id, context=prompt_context, **request)
+        if await send_stream_reply(context, chat_id, reply_to_id, chunks):
+            replies.inc(PRIORITY_NAMES[request['priority']])
+        return
+
+    reply = await gemini_reply(chat_id=chat_id, context=prompt_context, **request)
+    if not reply:
+        return
+
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text=reply,
+        reply_to_message_id=reply_to_id
+    )
+    replies.inc(PRIORITY_NAMES[request['priority']])
+
+
+async def reply_to_mentions(context: ContextTypes.DEFAULT_TYPE, chat_id, group_name):
+    """Answer every mention collected in the chat's coalescing window with a single reply."""
+    await asyncio.sleep(coalesce_window)
+    mentions = pending_mentions.pop(chat_id, [])
+    if not mentions:
+        return
+
+    user_nickname, _, reply_to_id = mentions[-1]
+    # The handler that queued these mentions has returned by now, so the batched reply gets its own trace
+    with tracer.trace('reply_to_mentions', chat_id=chat_id):
+        try:
+            with span('construct_context'):
+                ctr = construct_context(chat_id)
+            with span('build_context'):
+                message = build_batch_context(chat_id, [(nickname, text) for nickname, text, _ in mentions])
+
+            await send_gemini_reply(
+                context,
+                chat_id,
+                reply_to_id,
+                prompt_context=ctr,
+                message=message,
+                bot_statement="",
+                user_nickname=user_nickname,
+                group_name=group_name,
+                persona=persona,
+                per=per,
+                priority=PRIORITY_MENTION
+            )
+        except Exception as e:
+            logger.warning(e)
+
+
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_chat.type in ["group", "supergroup"] and update.message:
         user_input = update.message.text
@@ -82,47 +238,49 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                     logger.info(f"From user: {user_nickname} receive message: {user_input}")
 
-                    ctr = construct_context()
-                    message = build_context(user_nickname, user_input)
-
-                    reply = await gemini_reply(
-                        context=ctr,
+                    if coalesce_window > 0:
+                        if chat_id not in pending_mentions:
+                            pending_mentions[chat_id] = []
+                            context.application.create_task(reply_to_mentions(context, chat_id, group_name))
+                        pending_mentions[chat_id].append((user_nickname, user_input, reply_to_id))
+                        return
+
+                    with span('construct_context'):
+                        ctr = construct_context(chat_id)
+                    with span('build_context'):
+                        message = build_context(chat_id, user_nickname, user_input)
+
+                    await send_gemini_reply(
+                        context,
+                        chat_id,
+                        reply_to_id,
+                        prompt_context=ctr,
                         message=message,
                         bot_statement="",
                         user_nickname=user_nickname,
                         group_name=group_name,
                         persona=persona,
                         per=per,
-                        bot_model=bot_model,
-                        mdl=mdl
-                    )
-
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=reply,
-                        reply_to_message_id=reply_to_id
+                        priority=PRIORITY_MENTION
                     )
                 elif random.randint(1, 30) == 3:
                     logger.info(f"From user: {user_nickname} receive message: {user_input}")
 
-                    message = build_context(user_nickname, user_input)
+                    with span('build_context'):
+                        message = build_context(chat_id, user_nickname, user_input)
 
-                    reply = await gemini_reply(
-                        context="",
+                    await send_gemini_reply(
+                        context,
+                        chat_id,
+                        reply_to_id,
+                        prompt_context="",
                         message=message,
                         bot_statement="",
                         user_nickname=user_nickname,
                         group_name=group_name,
                         persona=persona,
                         per=per,
-                        bot_model=bot_model,
-                        mdl=mdl
-                    )
-
-                    await context.bot.send_message(
-                        chat_id=update.effective_chat.id,
-                        text=reply,
-                        reply_to_message_id=reply_to_id
+                        priority=PRIORITY_AMBIENT
                     )
             except Exception as e:
                 logger.warning(e)
@@ -225,6 +383,11 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle bot errors and exceptions."""
+    if isinstance(context.error, RetryAfter):
+        # The outbound limiter already retried; drop this message rather than the whole bot
+        logger.warning(f"Message dropped by Telegram flood control: {context.error}")
+        return
+
     logger.critical("Error:", exc_info=context.error)
 
     tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
@@ -259,6 +422,47 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     sys.exit(1)
 
 
+async def gemini_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id != admin:
+        await update.message.reply_text("You are not authorized.")
+        return
+
+    stats = scheduler.stats()
+    text = (f"Gemini queue depth: {stats['queue_depth']}, in flight: {stats['in_flight']}\n"
+            f"Queue wait: avg {stats['wait_avg']:.2f}s, p95 {stats['wait_p95']:.2f}s, max {stats['wait_max']:.2f}s\n"
+            f"Served: " + ", ".join(f"{k} {v}" for k, v in stats['served'].items()) + "\n"
+            f"Dropped ambient replies: {stats['shed']}\n")
+    for k in key_pool.stats():
+        text += (f"\n{k['key']}: {k['requests']} requests, {k['in_flight']} in flight, {k['failures']} failures "
+                 f"({k['quota_errors']} quota)")
+        if k['benched_for']:
+            text += f", benched for {k['benched_for']:.0f}s"
+
+    routing = router.stats()
+    text += f"\n\nModel in use: {routing['current']}"
+    for m in routing['models']:
+        text += (f"\n{m['model']}: {m['routed']} routed, p95 {m['p95']:.2f}s, "
+                 f"errors {m['error_rate']:.0%} of last {m['samples']}"
+                 f"{'' if m['healthy'] else ', unhealthy'}"
+                 f"{'' if m['breaker'] == 'closed' else ', circuit ' + m['breaker']}")
+    for at, previous, chosen, reason in routing['decisions']:
+        text += f"\n{time.strftime('%H:%M:%S', time.localtime(at))} {previous} -> {chosen} ({reason})"
+
+    outbound = limiter.stats()
+    text += (f"\n\nTelegram queue: {outbound['waiting']} waiting, {outbound['sent']} sent to {outbound['chats']} chats, "
+             f"{outbound['retries']} flood retries\n"
+             f"Send wait: avg {outbound['wait_avg']:.2f}s, p95 {outbound['wait_p95']:.2f}s, "
+             f"max {outbound['wait_max']:.2f}s")
+    coalesced = edits.stats()
+    text += f"\nMessage edits: {coalesced['sent']} sent, {coalesced['coalesced']} collapsed into newer ones"
+    slowest = tracer.slowest(3)
+    if slowest:
+        text += "\n\nSlowest recent updates: " + ", ".join(
+            f"{t.name} {t.duration:.2f}s (update {t.update_id})" for t in slowest)
+    await update.message.reply_text(text)
+
+
 async def stop_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id != admin:
@@ -281,43 +485,192 @@ async def stop_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.application.create_task(delayed_shutdown())
 
 
+def add_handlers(app):
+    def timed_handler(name, callback):
+        return timed(handler_seconds, traced(name)(callback), name)
+
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler('message', message_handler)))
+
+    persona_handler = ConversationHandler(
+        entry_points=[CommandHandler("select", timed_handler('select', persona_select_starter))],
+        states={
+            SPE: [CallbackQueryHandler(timed_handler('select_persona', selection_callback_handler))],
+        },
+        fallbacks=[CommandHandler("cancel", timed_handler('cancel', cancel))]
+    )
+    app.add_handler(persona_handler)
+    # app.add_handler(CommandHandler("persona", persona_starter))
+    # app.add_handler(CallbackQueryHandler(approval_callback_handler, pattern="^(approve|reject):"))
+
+    # blackjack game handler
+    app.add_handler(CommandHandler("blackjack", timed_handler('blackjack', lambda u, c: start(u, c, groups=groups))))
+    app.add_handler(CallbackQueryHandler(timed_handler('blackjack_join', join), pattern="^join$"))
+    app.add_handler(CallbackQueryHandler(timed_handler('blackjack_action', action_handler), pattern="^(hit|stand)$"))
+    app.add_handler(CallbackQueryHandler(timed_handler('blackjack_bet', bet_callback_handler),
+                                         pattern=r"^(bet_|done$)"))
+    app.add_handler(CallbackQueryHandler(timed_handler('blackjack_insurance', insurance_handler),
+                                         pattern="^insurance_"))
+
+    app.add_handler(CommandHandler("add_balance",
+                                   timed_handler('add_balance', lambda u, c: add_balance(u, c, groups=groups))))
+
+    app.add_error_handler(error_handler)
+    app.add_handler(CommandHandler("stop_bot", timed_handler('stop_bot', stop_bot)))
+    app.add_handler(CommandHandler("gemini_stats", timed_handler('gemini_stats', gemini_stats)))
+
+
+def serve_metrics(job_queue):
+    """Serve the metrics in the Prometheus text format on metrics_listen:metrics_port once the bot runs."""
+    port = bot.get('metrics_port', 9464)
+    if not port:
+        return
+    listen_on = bot.get('metrics_listen', '127.0.0.1')
+
+    async def start_server(context):
+        try:
+            await registry.serve(listen_on, port)
+        except OSError as e:
+            logger.warning(f"Metrics endpoint not started on {listen_on}:{port}: {e}")
+            return
+        logger.info(f"Serving metrics on http://{listen_on}:{port}/metrics")
+
+    job_queue.run_once(start_server, 0)
+
+
+def use_fast_event_loop():
+    """Run on uvloop when it is installed, unless event_loop is set to "asyncio"."""
+    if bot.get('event_loop', 'auto') == 'asyncio':
+        return
+    try:
+        import uvloop
+    except ImportError:
+        return
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    logger.info("Using the uvloop event loop.")
+
+
+def run_webhook(app):
+    """Receive updates on an embedded HTTP server instead of polling for them."""
+    url = bot.get('webhook_url')
+    if not url:
+        raise ValueError("webhook mode needs webhook_url, the public HTTPS address Telegram posts updates to")
+    # Telegram echoes the secret in a header on every request; anything without it is rejected
+    secret = bot.get('webhook_secret') or secrets.token_urlsafe(32)
+    path = bot.get('webhook_path', '')
+
+    logger.info(f"Start listening for updates at {url}...")
+    app.run_webhook(
+        listen=bot.get('webhook_listen', '0.0.0.0'),
+        port=bot.get('webhook_port', 8443),
+        url_path=path,
+        webhook_url=url,
+        secret_token=secret,
+        max_connections=bot.get('webhook_max_connections', 40),
+        cert=bot.get('webhook_cert'),
+        key=bot.get('webhook_key'),
+        allowed_updates=Update.ALL_TYPES,
+        # Telegram holds updates while the bot restarts; handle them instead of dropping them
+        drop_pending_updates=False
+    )
+
+
+def run_sharded(workers):
+    """Receive updates in this process and hand each chat's updates to one of `workers` bot processes."""
+    if not bot.get('webhook_url'):
+        raise ValueError("workers > 1 needs webhook_url, the dispatcher receives updates as a webhook")
+    directory = bot.get('shard_socket_dir', os.path.join(tempfile.gettempdir(), 'gemini_tgbot'))
+    os.makedirs(directory, exist_ok=True)
+    secret = bot.get('webhook_secret') or secrets.token_urlsafe(32)
+    context = multiprocessing.get_context('spawn')
+    # Only this process writes the log file, the workers send their records here
+    worker_log_queue = listen(context.Queue())
+
+    # spawn rather than fork, so no worker inherits this process's SQLite connection
+    processes = [context.Process(
+        target=run_worker, args=(shard, workers, directory, worker_log_queue), name=f"worker-{shard}") for shard in range(workers)]
+    for process in processes:
+        process.start()
+    try:
+        asyncio.run(run_dispatcher(workers, directory, secret))
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join(10)
+
+
+async def run_dispatcher(workers, directory, secret):
+    dispatcher = Dispatcher(workers, directory, secret, logger)
+    cert, cert_key = bot.get('webhook_cert'), bot.get('webhook_key')
+    ssl_options = {'certfile': cert, 'keyfile': cert_key} if cert and cert_key else None
+    dispatcher.make_app(bot.get('webhook_path', '')).listen(
+        bot.get('webhook_port', 8443), bot.get('webhook_listen', '0.0.0.0'), ssl_options=ssl_options)
+
+    async with Bot(bot_token) as telegram_bot:
+        await telegram_bot.set_webhook(
+            url=bot['webhook_url'],
+            certificate=open(cert, 'rb') if cert else None,
+            secret_token=secret,
+            max_connections=bot.get('webhook_max_connections', 40),
+            allowed_updates=Update.ALL_TYPES
+        )
+    logger.info(f"Dispatching updates from {bot['webhook_url']} to {workers} workers...")
+    await asyncio.Event().wait()
+
+
+def run_worker(shard, workers, directory, worker_log_queue):
+    global log_queue
+
+    log_queue = worker_log_queue
+    # The Gemini and Telegram budgets are for the whole bot, split them between the workers
+    bot['gemini_rpm'] = bot.get('gemini_rpm', 60) / workers
+    bot['telegram_rate'] = bot.get('telegram_rate', 30) / workers
+    # Every worker has its own metrics, on the ports after metrics_port
+    if bot.get('metrics_port', 9464):
+        bot['metrics_port'] = bot.get('metrics_port', 9464) + 1 + shard
+    load_config()
+    use_fast_event_loop()
+
+    app = (Application.builder().token(bot_token).concurrent_updates(True)
+           .rate_limiter(limiter).updater(None).build())
+    add_handlers(app)
+    schedule_flush(app.job_queue)
+    serve_metrics(app.job_queue)
+    ring = HashRing(workers)
+    restore_games(app.job_queue, owns=lambda chat_id: ring.shard(chat_id) == shard)
+    asyncio.run(serve_worker(app, socket_path(directory, shard), logger, on_stop=save_balances))
+
+
 def main():
     try:
         load_config()
+        use_fast_event_loop()
         logger.info("***** TELEGRAM BOT START *****")
 
         if not bot_token or bot_token == "YOUR_BOT_TOKEN":
             logger.error('Error: no bot token found. Please set up your bot token in config.')
             sys.exit(1)
 
-        app = Application.builder().token(bot_token).build()
-        app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-
-        persona_handler = ConversationHandler(
-            entry_points=[CommandHandler("select", persona_select_starter)],
-            states={
-                SPE: [CallbackQueryHandler(selection_callback_handler)],
-            },
-            fallbacks=[CommandHandler("cancel", cancel)]
-        )
-        app.add_handler(persona_handler)
-        # app.add_handler(CommandHandler("persona", persona_starter))
-        # app.add_handler(CallbackQueryHandler(approval_callback_handler, pattern="^(approve|reject):"))
-
-        # blackjack game handler
-        app.add_handler(CommandHandler("blackjack", lambda u, c: start(u, c, groups=groups)))
-        app.add_handler(CallbackQueryHandler(join, pattern="^join$"))
-        app.add_handler(CallbackQueryHandler(action_handler, pattern="^(hit|stand)$"))
-        app.add_handler(CallbackQueryHandler(bet_callback_handler, pattern=r"^(bet_|done$)"))
-        app.add_handler(CallbackQueryHandler(insurance_handler, pattern="^insurance_"))
-
-        app.add_handler(CommandHandler("add_balance", lambda u, c: add_balance(u, c, groups=groups)))
-
-        app.add_error_handler(error_handler)
-        app.add_handler(CommandHandler("stop_bot", stop_bot))
-
-        logger.info("Start polling for updates...")
-        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+        if bot.get('workers', 1) > 1:
+            # The dispatcher only forwards updates; each worker builds its own application,
+            # flushes its own balances and restores the tables of its chats
+            run_sharded(bot['workers'])
+            return
+
+        # Handlers await Gemini for seconds at a time, so let updates from other
+        # chats run concurrently instead of queueing behind the current one.
+        app = (Application.builder().token(bot_token).concurrent_updates(True)
+               .rate_limiter(limiter).build())
+        add_handlers(app)
+        schedule_flush(app.job_queue)
+        serve_metrics(app.job_queue)
+        restore_games(app.job_queue)
+
+        if bot.get('mode', 'polling') == 'webhook':
+            run_webhook(app)
+        else:
+            logger.info("Start polling for updates...")
+            app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
 
     except BaseException as e:
         logger.error(e)
@@ -1,9 +1,15 @@
+import atexit
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
 logger = logging.getLogger(__name__)
 log_file = ""
+# File and console handlers, run by listener threads so logging never blocks the event loop
+handlers = []
+listeners = []
 
 
 def load_log_file(log_path):
@@ -15,40 +21,95 @@ def load_log_file(log_path):
     log_file = log_path
 
 
-def setup_logger(log_path):
+class JsonFormatter(logging.Formatter):
+    """One compact JSON object per line, with the fields passed as ``extra={'fields': {...}}``."""
+
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'name': record.name,
+            'message': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def setup_logger(log_path, max_bytes=1024 * 1024, backups=2, fmt="text", use_queue=True, log_queue=None):
+    """Log to ``log_path`` and the console.
+
+    With ``use_queue`` the records are handed to a listener thread that does the writing and
+    rotation. Worker processes pass the ``log_queue`` of the process that owns the log file
+    instead, which then writes their records too (see ``listen``).
+    """
+    stop_logging()
+    logger.setLevel(logging.INFO)
+    if logger.hasHandlers():
+        logger.handlers.clear()
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    if log_queue is not None:
+        logger.addHandler(QueueHandler(log_queue))
+        logger.info(f"Logger of process {os.getpid()} setup successfully.")
+        return
+
     load_log_file(log_path)
 
-    log_format = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+    if fmt == "json":
+        formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 
     file_handler = RotatingFileHandler(
         log_file,
-        maxBytes=1 * 1024 * 1024,  # 1 MB
-        backupCount=2
+        maxBytes=max_bytes,
+        backupCount=backups,
+        encoding="utf-8"
     )
     file_handler.setLevel(logging.INFO)
-    file_handler.setFormatter(logging.Formatter(log_format))
+    file_handler.setFormatter(formatter)
 
     console_handler = logging.StreamHandler()
     console_handler.setLevel(logging.INFO)
-    console_handler.setFormatter(logging.Formatter(log_format))
+    console_handler.setFormatter(formatter)
 
-    logger.setLevel(logging.INFO)
+    for handler in handlers:
+        handler.close()
+    handlers[:] = [file_handler, console_handler]
+    if use_queue:
+        logger.addHandler(QueueHandler(listen(queue.SimpleQueue())))
+    else:
+        for handler in handlers:
+            logger.addHandler(handler)
 
-    if logger.hasHandlers():
-        logger.handlers.clear()
+    logger.info("Logger setup successfully.")
 
-    logger.addHandler(file_handler)
-    logger.addHandler(console_handler)
 
-    logging.getLogger("httpx").setLevel(logging.WARNING)
-    logger.info("Logger setup successfully.")
+def listen(log_queue):
+    """Write the records arriving on ``log_queue`` with this process's handlers, on a background thread."""
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    listeners.append(listener)
+    return log_queue
+
+
+def stop_logging():
+    """Write out everything still queued and stop the listener threads."""
+    while listeners:
+        listeners.pop().stop()
+
+
+atexit.register(stop_logging)
 
 
 def log_message(user_name, chat_name, is_bot, message_type, message_content):
     """Logs message details for tracking bot interactions."""
+    fields = {'user_name': user_name,
+              'chat_name': chat_name, 'is_bot': is_bot,
+              'message_type': message_type,
+              'message_content': message_content}
     logger.info(
         ' %(user_name)s - %(chat_name)s - %(is_bot)s - %(message_type)s - %(message_content)s',
-        {'user_name': user_name,
-         'chat_name': chat_name, 'is_bot': is_bot,
-         'message_type': message_type,
-         'message_content': message_content})
+        fields, extra={'fields': fields})
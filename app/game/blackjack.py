@@ -1,91 +1,326 @@
+import asyncio
+import functools
+import json
 import os
-import random
 import re
-import traceback
+import time
 
 import bleach
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (ContextTypes)
 # from app.config.logger_config import logger
-import google.generativeai as genai
 
-SAFETY_SETTINGS = {
-    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-}
+from AI.gemini import generate_text
+from AI.retry import classify
+from AI.scheduler import PRIORITY_GAME, PRIORITY_MENTION
+from game.cards import Hand, new_deck, card_name, card_value, format_hand, ACE
+from game.store import GameStore, DEFAULT_BALANCE
+from game.strategy import basic_strategy, HIT, STAND
+from infra.coalesce import edits
+from infra.metrics import registry, measure, gemini_seconds
+from infra.tracing import traced
 
 # Game state storage
 games = {}
 
-suits = ['♠', '♥', '♦', '♣']
-ranks = ['A', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K']
-deck_template = [f"{rank}{suit}" for suit in suits for rank in ranks]
 balances = {}
 
+# Seconds each phase of a table waits for the players
+JOIN_WINDOW = 20
+BET_WINDOW = 20
+TURN_TIMEOUT = 20
+INSURANCE_WINDOW = 10
+
+# How Gemini plays its hand: 'strategy', 'llm' or 'llm-with-strategy-fallback-on-timeout'
+AI_MODES = ('strategy', 'llm', 'llm-with-strategy-fallback-on-timeout')
+AI_MODE = 'llm-with-strategy-fallback-on-timeout'
+AI_TIMEOUT = 3
+
 logger = None
+store = None
+
+# Balances and tables changed since the last flush, written every FLUSH_INTERVAL seconds (0 writes them at once)
+dirty = set()
+dirty_games = set()
+ended_games = set()
+# Balances as last read from or written to the store; flushes write the difference
+persisted = {}
+flushing = set()
+FLUSH_INTERVAL = 5
+
+registry.gauge('blackjack_tables', 'Blackjack tables open in this process.', lambda: len(games))
+registry.gauge('blackjack_balances', 'Player balances held in memory.', lambda: len(balances))
+
+# chat_id -> [lock held while a handler or job of that chat's table runs, callbacks holding or waiting]
+table_locks = {}
+
+
+def per_table(callback):
+    """Run a table's handler or job with the chat's lock held.
+
+    Updates are processed concurrently, so without it a double Stand, or a Stand racing
+    timeout_player, could both pass the turn check before either advances the turn.
+    """
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        if hasattr(args[0], 'update_id'):
+            chat_id = args[0].effective_chat.id
+        else:
+            chat_id = args[0].job.chat_id
+        entry = table_locks.get(chat_id)
+        if entry is None:
+            entry = table_locks[chat_id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                return await callback(*args, **kwargs)
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del table_locks[chat_id]
+
+    return wrapper
+
 
+def configure_ai(mode=AI_MODE, timeout=AI_TIMEOUT):
+    global AI_MODE, AI_TIMEOUT
+    if mode not in AI_MODES:
+        raise ValueError(f"Unknown blackjack_ai mode: {mode}")
+    AI_MODE = mode
+    AI_TIMEOUT = timeout
 
-def load_balances(log, filename="./app/data/balances.txt"):
-    # global balances
-    global logger
+
+# Text files older versions kept the balances in: save_balances() wrote the live ones to the
+# working directory, load_balances() read the one under app/data
+LEGACY_BALANCES = ("balances.txt", "./app/data/balances.txt")
+
+
+def load_balances(log, filename="./app/data/balances.db", legacy=LEGACY_BALANCES, flush_interval=5):
+    global logger, store, FLUSH_INTERVAL
     logger = log
+    FLUSH_INTERVAL = flush_interval
+
+    store = GameStore(filename)
+    found = [path for path in legacy if os.path.exists(path)]
+    if found:
+        # The most recently written file has the live balances; on a tie the first listed wins
+        source = max(found, key=os.path.getmtime)
+        migrated = store.migrate_text(source)
+        if migrated:
+            logger.info(f"Migrated {migrated} balances from {source} to {filename}.")
+            for path in found:
+                if path != source:
+                    logger.info(f"Ignored {path}, {source} was written more recently.")
+    balances.update(store.load())
+    persisted.update(balances)
+
+    if 'AI' not in balances:
+        balances['AI'] = 1000
+        dirty.add('AI')
+
+    logger.info('Loading balance successfully.')
+
+
+def mark_balances(user_ids):
+    """Queue the balances of user_ids for the next flush, or write them now if write-behind is off."""
+    dirty.update(user_ids)
+    if FLUSH_INTERVAL <= 0:
+        save_balances()
+
+
+def snapshot_game(chat_id, phase=None, timeout=None):
+    """Queue the table for the next flush, optionally moving it to phase with a deadline timeout seconds away."""
+    game = games[chat_id]
+    if phase is not None:
+        game['phase'] = phase
+        game['deadline'] = time.time() + (timeout or 0)
+    dirty_games.add(chat_id)
+    if FLUSH_INTERVAL <= 0:
+        save_balances()
 
-    try:
-        if not os.path.exists(filename):
-            open(filename, "w").close()
-
-        with open(filename, "r") as f:
-            for line in f:
-                user_id, amount = line.strip().split(":")
-                if user_id == 'AI':
-                    balances[user_id] = int(amount)
-                else:
-                    balances[int(user_id)] = int(amount)
 
-        if 'AI' not in balances:
-            balances['AI'] = 1000
+def end_game(chat_id):
+    del games[chat_id]
+    dirty_games.discard(chat_id)
+    ended_games.add(chat_id)
+    if FLUSH_INTERVAL <= 0:
+        save_balances()
+
+
+def dump_game(game):
+    state = {key: value for key, value in game.items() if key not in ('jobs', 'AI')}
+    state['hands'] = {pid: hand.cards for pid, hand in game['hands'].items()}
+    state['dealer'] = game['dealer'].cards
+    state['betting_done'] = list(game['betting_done'])
+    state['AI'] = {key: value.cards if key == 'hands' else value
+                  for key, value in game['AI'].items() if key != 'bet_task'}
+    return json.dumps(state, ensure_ascii=False, separators=(',', ':'))
+
+
+def load_game(text):
+    state = json.loads(text)
+    # JSON object keys are strings, player ids are ints
+    for key in ('names', 'hands', 'bets', 'insurance'):
+        state[key] = {int(pid): value for pid, value in state[key].items()}
+    state['hands'] = {pid: Hand(cards) for pid, cards in state['hands'].items()}
+    state['dealer'] = Hand(state['dealer'])
+    state['betting_done'] = set(state['betting_done'])
+    if 'hands' in state['AI']:
+        state['AI']['hands'] = Hand(state['AI']['hands'])
+    state['jobs'] = {}
+    return state
+
+
+def take_dirty():
+    sent = {user_id: balances[user_id] for user_id in dirty if user_id in balances}
+    snapshots = {chat_id: dump_game(games[chat_id]) for chat_id in dirty_games if chat_id in games}
+    ended = set(ended_games)
+    dirty.clear()
+    dirty_games.clear()
+    ended_games.clear()
+    return sent, snapshots, ended
+
+
+def deltas_of(sent):
+    return {user_id: amount - persisted.get(user_id, DEFAULT_BALANCE) for user_id, amount in sent.items()}
+
+
+def merge_balances(fresh, sent):
+    """Take the stored balances, keeping changes made here since sent was taken."""
+    for user_id, amount in fresh.items():
+        local = balances.get(user_id, sent[user_id]) - sent[user_id]
+        balances[user_id] = amount + local
+        persisted[user_id] = amount
+
+
+async def flush_balances(context: ContextTypes.DEFAULT_TYPE = None):
+    """Write the changed balances and tables in one transaction from a worker thread."""
+    sent, snapshots, ended = take_dirty()
+    if not sent and not snapshots and not ended:
+        return
+    flushing.update(sent)
+    try:
+        fresh = await asyncio.to_thread(store.save, deltas_of(sent), snapshots, ended)
+    except Exception as e:
+        logger.error(f"Failed to save {len(sent)} balances and {len(snapshots) + len(ended)} tables, "
+                     f"retrying on the next flush: {e}")
+        dirty.update(sent)
+        dirty_games.update(chat_id for chat_id in snapshots if chat_id in games)
+        ended_games.update(chat_id for chat_id in ended if chat_id not in games)
+        return
+    finally:
+        flushing.difference_update(sent)
+    merge_balances(fresh, sent)
 
-        logger.info('Loading balance successfully.')
-    except FileNotFoundError:
-        logger.error("Balance file not found")
 
+async def refresh_balances(user_ids):
+    """Reload players' balances from the store, which other worker processes may have changed."""
+    if store is None:
+        return
+    user_ids = [user_id for user_id in user_ids if user_id not in flushing]
+    if not user_ids:
+        return
+    before = {user_id: persisted.get(user_id) for user_id in user_ids}
+    # The store's lock is also held by flushes, don't wait for it on the event loop
+    stored = await asyncio.to_thread(store.get, user_ids)
+    for user_id, amount in stored.items():
+        # A flush that started or finished during the read has newer amounts than this read
+        if user_id in flushing or persisted.get(user_id) != before[user_id]:
+            continue
+        pending = balances[user_id] - persisted.get(user_id, DEFAULT_BALANCE) if user_id in balances else 0
+        balances[user_id] = amount + pending
+        persisted[user_id] = amount
+
+
+def schedule_flush(job_queue):
+    if store is not None and FLUSH_INTERVAL > 0:
+        job_queue.run_repeating(flush_balances, interval=FLUSH_INTERVAL, first=FLUSH_INTERVAL)
+
+
+def save_balances():
+    """Write the changed balances and tables synchronously, for shutdown."""
+    if store is None:
+        return
+    sent, snapshots, ended = take_dirty()
+    merge_balances(store.save(deltas_of(sent), snapshots, ended), sent)
 
-def save_balances(filename="balances.txt"):
-    with open(filename, "w") as f:
-        for user_id, amount in balances.items():
-            f.write(f"{user_id}:{amount}\n")
 
+def restore_games(job_queue, owns=None):
+    """Reopen the tables saved by the last run and re-arm their timers from the saved deadlines.
 
-def deal_card(deck):
-    return deck.pop()
+    owns(chat_id) limits this to the chats the current worker process serves.
+    """
+    if store is None:
+        return
+    for chat_id, text in store.load_games().items():
+        if owns is not None and not owns(chat_id):
+            continue
+        try:
+            game = load_game(text)
+        except Exception as e:
+            logger.error(f"Dropping unreadable blackjack snapshot of chat {chat_id}: {e}")
+            ended_games.add(chat_id)
+            continue
+        games[chat_id] = game
+        delay = max(0.0, game['deadline'] - time.time())
+        phase = game['phase']
+
+        if phase == 'join':
+            job_queue.run_once(send_bet, delay, chat_id=chat_id)
+        elif phase == 'bet':
+            job_queue.run_once(betting_timeout, delay, chat_id=chat_id, data={'chat_id': chat_id})
+        elif phase == 'insurance':
+            job_queue.run_once(insurance_timeout, delay, chat_id=chat_id,
+                               data={'chat_id': chat_id, 'msg_id': game['insurance_message_id']})
+        elif phase == 'turn':
+            player_id = game['players'][game['current']]
+            game['jobs'][player_id] = job_queue.run_once(
+                timeout_player, delay, chat_id=chat_id,
+                data={'chat_id': chat_id, 'player_id': player_id, 'msg_id': game['last_turn']})
+        else:
+            job_queue.run_once(resume_game, 0, chat_id=chat_id)
+        logger.info(f"Restored blackjack game in chat {chat_id} ({phase}).")
 
 
-def get_card_value(card):
-    rank = card[:-1]
-    if rank in ['J', 'Q', 'K']:
-        return 10
-    elif rank == 'A':
-        return 11
-    else:
-        return int(rank)
+@traced('resume_game')
+@per_table
+async def resume_game(context: ContextTypes.DEFAULT_TYPE):
+    """Pick up a restored table that was dealing or settling, refunding the bets if that fails."""
+    chat_id = context.job.chat_id
+    game = games.get(chat_id)
+    if not game:
+        return
+    try:
+        if game['phase'] == 'deal':
+            await start_game(context, chat_id)
+        else:
+            await finish_game(context, chat_id)
+    except Exception as e:
+        logger.error(f"Could not resume blackjack game in chat {chat_id}, refunding bets: {e}")
+        if chat_id in games:
+            await refund_game(context, chat_id)
 
 
-def calculate_hand_value(hand):
-    value = sum(get_card_value(card) for card in hand)
-    aces = sum(1 for card in hand if card.startswith('A'))
-    while value > 21 and aces:
-        value -= 10
-        aces -= 1
-    return value
+async def refund_game(context: ContextTypes.DEFAULT_TYPE, chat_id):
+    game = games[chat_id]
+    # Bets leave the balances when betting closes, Gemini's when it bets
+    if game['phase'] not in ('join', 'bet'):
+        for pid in game['players']:
+            balances[pid] = balances.get(pid, 1000) + game['bets'].get(pid, 0)
+    balances['AI'] += game['AI'].get('bets', 0)
+    mark_balances(['AI', *game['players']])
+    end_game(chat_id)
+    await context.bot.send_message(
+        chat_id=chat_id,
+        text="The blackjack game was interrupted and all bets were refunded. Send /blackjack to start a new game.")
 
 
-def format_hand(hand):
-    return ' '.join(hand)
+def deal_card(deck):
+    return deck.pop()
 
 
+@traced('timeout_player')
+@per_table
 async def timeout_player(context: ContextTypes.DEFAULT_TYPE):
     data = context.job.data
     chat_id = data['chat_id']
@@ -96,20 +331,21 @@ async def timeout_player(context: ContextTypes.DEFAULT_TYPE):
     if not game or game['players'][game['current']] != player_id:
         return
 
-    await context.bot.edit_message_text(chat_id=chat_id,
-                                        message_id=message_id,
-                                        text=(f"{game['names'][player_id]} did not respond in time.\n"
-                                              f"Stands with: "
-                                              f"{format_hand(game['hands'][player_id])} "
-                                              f"(Total: {calculate_hand_value(game['hands'][player_id])})"),
-                                        parse_mode='HTML')
     game['context'] += (f"{game['names'][player_id]} stands with: {format_hand(game['hands'][player_id])} "
-                        f"(Total: {calculate_hand_value(game['hands'][player_id])})")
+                        f"(Total: {game['hands'][player_id].value})")
     game['context'] += '\n\n'
     game['current'] += 1
+    # The turn is closed before the edit goes out, which takes the edit window
+    edits.edit(context.bot, chat_id, message_id,
+               text=(f"{game['names'][player_id]} did not respond in time.\n"
+                     f"Stands with: "
+                     f"{format_hand(game['hands'][player_id])} "
+                     f"(Total: {game['hands'][player_id].value})"),
+               parse_mode='HTML')
     await send_next_turn(context, chat_id, None)
 
 
+@traced('send_next_turn')
 async def send_next_turn(context: ContextTypes.DEFAULT_TYPE, chat_id, message_id):
     game = games[chat_id]
     if game['current'] >= len(game['players']):
@@ -118,7 +354,7 @@ async def send_next_turn(context: ContextTypes.DEFAULT_TYPE, chat_id, message_id
 
     player_id = game['players'][game['current']]
     hand = game['hands'][player_id]
-    value = calculate_hand_value(hand)
+    value = hand.value
     keyboard = [
         [
             InlineKeyboardButton("Hit", callback_data="hit"),
@@ -127,7 +363,7 @@ async def send_next_turn(context: ContextTypes.DEFAULT_TYPE, chat_id, message_id
     ]
     markup = InlineKeyboardMarkup(keyboard)
     text = (f"<b>{game['names'][player_id]}</b>'s turn\nHand: {format_hand(hand)} (Total: {value})\n"
-            f"You have 20 seconds to choose.")
+            f"You have {TURN_TIMEOUT} seconds to choose.")
     if message_id is None:
         msg = await context.bot.send_message(
             chat_id=chat_id,
@@ -135,20 +371,17 @@ async def send_next_turn(context: ContextTypes.DEFAULT_TYPE, chat_id, message_id
             reply_markup=markup,
             parse_mode='HTML'
         )
-        game['last_turn'] = msg.message_id
+        message_id = game['last_turn'] = msg.message_id
     else:
-        msg = await context.bot.edit_message_text(
-            chat_id=chat_id,
-            message_id=message_id,
-            text=text,
-            reply_markup=markup,
-            parse_mode='HTML'
-        )
-    job = context.job_queue.run_once(timeout_player, 20, chat_id=chat_id,
-                                     data={'chat_id': chat_id, 'player_id': player_id, 'msg_id': msg.message_id})
+        # Quick hits collapse into one edit showing the latest hand
+        edits.edit(context.bot, chat_id, message_id, text=text, reply_markup=markup, parse_mode='HTML')
+    job = context.job_queue.run_once(timeout_player, TURN_TIMEOUT, chat_id=chat_id,
+                                     data={'chat_id': chat_id, 'player_id': player_id, 'msg_id': message_id})
     game['jobs'][player_id] = job
+    snapshot_game(chat_id, 'turn', TURN_TIMEOUT)
 
 
+@per_table
 async def insurance_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -168,8 +401,11 @@ async def insurance_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         game['bets'][user_id] //= 2
     else:
         game['insurance'][user_id] = False
+    snapshot_game(chat_id)
 
 
+@traced('insurance_timeout')
+@per_table
 async def insurance_timeout(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.data['chat_id']
     msg_id = context.job.data['msg_id']
@@ -180,9 +416,9 @@ async def insurance_timeout(context: ContextTypes.DEFAULT_TYPE):
             game['insurance'][pid] = False  # default to no
 
     dealer = game['dealer']
-    if calculate_hand_value(dealer) == 21:
+    if dealer.value == 21:
         text = (
-            f"Dealer hand: {format_hand(dealer)} (Total: {dealer})\nDealer has Blackjack!\n")
+            f"Dealer hand: {format_hand(dealer)} (Total: {dealer.value})\nDealer has Blackjack!\n")
         for pid in game['players']:
             if game['insurance'].get(pid):
                 payout = game['bets'][pid] * 2  # 2:1 payout
@@ -198,7 +434,8 @@ async def insurance_timeout(context: ContextTypes.DEFAULT_TYPE):
         # await finish_game(context, chat_id)
 
         logger.info(f"Blackjack game ends in chat {chat_id}.")
-        del games[chat_id]
+        mark_balances(['AI', *game['players']])
+        end_game(chat_id)
     else:
         await context.bot.edit_message_text(
             message_id=msg_id,  # edit the message with the insurance result
@@ -206,6 +443,7 @@ async def insurance_timeout(context: ContextTypes.DEFAULT_TYPE):
         await send_next_turn(context, chat_id, None)
 
 
+@traced('start_game')
 async def start_game(context: ContextTypes.DEFAULT_TYPE, chat_id):
     game = games[chat_id]
 
@@ -215,27 +453,26 @@ async def start_game(context: ContextTypes.DEFAULT_TYPE, chat_id):
         except Exception as e:
             logger.warning(f"Error deleting bet message: {e}.")
 
-    deck = deck_template.copy()
-    random.shuffle(deck)
+    deck = new_deck()
     game['deck'] = deck
 
     for player_id in game['players']:
-        game['hands'][player_id] = [deal_card(deck), deal_card(deck)]
+        game['hands'][player_id] = Hand((deal_card(deck), deal_card(deck)))
 
-    game['dealer'] = [deal_card(deck), deal_card(deck)]
-    game['AI']['hands'] = [deal_card(deck), deal_card(deck)]
+    game['dealer'] = Hand((deal_card(deck), deal_card(deck)))
+    game['AI']['hands'] = Hand((deal_card(deck), deal_card(deck)))
     game['current'] = 0
 
     dealer_hand = game['dealer']
     dealer_visible = dealer_hand[0]
-    dealer_total = calculate_hand_value(dealer_hand)
+    dealer_total = dealer_hand.value
 
     await context.bot.send_message(
         chat_id=chat_id,
-        text=f"Dealer's visible card: {dealer_visible}"
+        text=f"Dealer's visible card: {card_name(dealer_visible)}"
     )
 
-    if dealer_visible[0] == 'A':
+    if card_value(dealer_visible) == ACE:
         game['insurance'] = {}  # Track who bought insurance
         keyboard = [
             [InlineKeyboardButton(
@@ -249,7 +486,8 @@ async def start_game(context: ContextTypes.DEFAULT_TYPE, chat_id):
         )
         game['insurance_message_id'] = msg.message_id
         context.job_queue.run_once(
-            insurance_timeout, 10, data={'chat_id': chat_id, 'msg_id': msg.message_id})
+            insurance_timeout, INSURANCE_WINDOW, chat_id=chat_id, data={'chat_id': chat_id, 'msg_id': msg.message_id})
+        snapshot_game(chat_id, 'insurance', INSURANCE_WINDOW)
 
     # if dealer_total == 21:
     #     await context.bot.send_message(
@@ -267,6 +505,7 @@ async def start_game(context: ContextTypes.DEFAULT_TYPE, chat_id):
         await send_next_turn(context, chat_id, None)
 
 
+@per_table
 async def bet_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     try:
@@ -308,9 +547,11 @@ async def bet_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
         if bet_amount != game['bets'][user_id]:
             game['bets'][user_id] = bet_amount
+            snapshot_game(chat_id)
 
-            text = (f"20s to make you bet (default is 50). Current bets:\n\n"
-                    f"Gemini has bet {game['AI']['bets']} (Balance: {balances.get('AI')})\n")
+            text = f"{BET_WINDOW}s to make you bet (default is 50). Current bets:\n\n"
+            if 'bets' in game['AI']:
+                text += f"Gemini has bet {game['AI']['bets']} (Balance: {balances.get('AI')})\n"
 
             for player_id in game['players']:
                 text += (f"{game['names'][player_id]} has bet {game['bets'][player_id]} "
@@ -327,10 +568,9 @@ async def bet_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYP
                 # [InlineKeyboardButton("Done", callback_data="done")]
             ]
 
-            await query.edit_message_text(
-                text=text,
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+            # Only the latest bet table is sent when players click faster than the edit window
+            edits.edit(context.bot, chat_id, query.message.message_id,
+                       text=text, reply_markup=InlineKeyboardMarkup(keyboard))
 
     elif data == 'done':
         if user_id not in game['betting_done']:
@@ -345,6 +585,8 @@ async def bet_callback_handler(update: Update, context: ContextTypes.DEFAULT_TYP
             # await start_game(context, chat_id)
 
 
+@traced('betting_timeout')
+@per_table
 async def betting_timeout(context: ContextTypes.DEFAULT_TYPE):
     data = context.job.data
     chat_id = data["chat_id"]
@@ -363,11 +605,36 @@ async def betting_timeout(context: ContextTypes.DEFAULT_TYPE):
     for pid, bet in game['bets'].items():
         if pid in game['players']:
             balances[pid] = balances.get(pid, 1000) - bet
+    mark_balances(game['players'])
+    snapshot_game(chat_id, 'deal')
 
     await start_game(context, chat_id)
 
 
+def fallback_bet(balance):
+    """Bet a tenth of the balance in steps of 50, at least 50 or all of it if less."""
+    return min(balance, max(50, balance // 10 // 50 * 50))
+
+
+@traced('gemini_bet')
+async def gemini_bet(balance):
+    prompt = (
+        "You are a Blackjack master. "
+        "Initial bet is 50 or all your balance if it is less than 50."
+        "The betting options are any positive whole number which is divisible by 50, "
+        "but don't bet more than your current balance. "
+        "Decide how much you want to bet for this round. Respond only with the number of your bet. "
+        "(e.g., 100, 200). Betting can be more aggressive, and sometimes you can try all in."
+    )
+    reply = await gemini_blackjack(prompt, f"Your current balance: {balance}\n")
+    reply = (reply or "").strip()
+    if re.fullmatch(r"\d+", reply):
+        return int(reply)
+
+
 # This is the async wrapper for JobQueue
+@traced('send_bet')
+@per_table
 async def send_bet(context: ContextTypes.DEFAULT_TYPE):
     chat_id = context.job.chat_id
     if chat_id not in games:
@@ -393,25 +660,24 @@ async def send_bet(context: ContextTypes.DEFAULT_TYPE):
     ]
 
     # load_balances()
-    text = "20s to make you bet (default is 50). Current bets:\n\n"
+    text = f"{BET_WINDOW}s to make you bet (default is 50). Current bets:\n\n"
     no_bal = []
 
+    # Gemini's balance is shared by every table, in every worker process
+    await refresh_balances(['AI', *game['players']])
     balance = balances['AI']
     if balance > 0:
-        prompt = (
-            f"You are a Blackjack master with a balance of {balance}. "
-            f"Initial bet is 50 or all your balance if it is less than 50."
-            "The betting options are any positive whole number which is divisible by 50, "
-            "but don't bet more than your current balance. "
-            "Decide how much you want to bet for this round. Respond only with the number of your bet. "
-            "(e.g., 100, 200). Betting can be more aggressive, and sometimes you can try all in."
-        )
-        reply = await gemini_blackjack(prompt, '')
-        reply = reply.strip()
-        bet = balance
-
-        if re.fullmatch(r"\d+", reply):
-            bet = int(reply)
+        # The bet was requested when the table opened; don't keep the players waiting for it
+        task = game['AI'].pop('bet_task', None)
+        bet = None
+        if task is not None and task.done() and not task.cancelled():
+            bet = task.result()
+        elif task is not None:
+            task.cancel()
+            logger.info(f"Gemini bet not ready in chat {chat_id}, using the fallback bet.")
+        if not bet:
+            bet = fallback_bet(balance)
+        bet = min(bet, balance)
 
         # balances['AI'] = balance - bet
         game['AI']['name'] = 'Gemini'
@@ -443,6 +709,8 @@ async def send_bet(context: ContextTypes.DEFAULT_TYPE):
 
     for p in no_bal:
         game['players'].remove(p)
+    mark_balances(['AI'])
+    snapshot_game(chat_id, 'bet', BET_WINDOW)
 
     message = await context.bot.send_message(
         chat_id=chat_id,
@@ -450,11 +718,13 @@ async def send_bet(context: ContextTypes.DEFAULT_TYPE):
         reply_markup=InlineKeyboardMarkup(keyboard)
     )
     game['bet_message_id'] = message.message_id
+    snapshot_game(chat_id)
     # await bet_callback_handler(context, chat_id)
     context.job_queue.run_once(
-        betting_timeout, when=20, data={"chat_id": chat_id})
+        betting_timeout, when=BET_WINDOW, chat_id=chat_id, data={"chat_id": chat_id})
 
 
+@per_table
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, groups=None):
     chat_id = update.effective_chat.id
     if chat_id in groups and chat_id not in games:
@@ -463,7 +733,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, groups=None)
             'players': [],
             'names': {},
             'hands': {},
-            'dealer': [],
+            'dealer': Hand(),
             'join_message_id': None,
             'bet_message_id': None,
             'last_turn': None,
@@ -477,15 +747,20 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE, groups=None)
         }
         join_button = [[InlineKeyboardButton("Join", callback_data="join")]]
         msg = await update.message.reply_text(
-            "Blackjack game starting in 20 seconds! Press Join:",
+            f"Blackjack game starting in {JOIN_WINDOW} seconds! Press Join:",
             reply_markup=InlineKeyboardMarkup(join_button)
         )
         games[chat_id]['join_message_id'] = msg.message_id
-        context.job_queue.run_once(send_bet, 20, chat_id=chat_id)
+        if balances.get('AI', 0) > 0:
+            # Decide Gemini's bet during the join window so send_bet doesn't wait on the LLM
+            games[chat_id]['AI']['bet_task'] = context.application.create_task(gemini_bet(balances['AI']))
+        context.job_queue.run_once(send_bet, JOIN_WINDOW, chat_id=chat_id)
+        snapshot_game(chat_id, 'join', JOIN_WINDOW)
     else:
         return
 
 
+@per_table
 async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     # await query.answer()
@@ -506,17 +781,18 @@ async def join(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if user.id not in game['players']:
         game['players'].append(user.id)
         game['names'][user.id] = user_nickname
-        ctx = 'Blackjack game starting in 20 seconds!\n'
+        snapshot_game(chat_id)
+        ctx = f'Blackjack game starting in {JOIN_WINDOW} seconds!\n'
         for player in game['players']:
             ctx += f"{game['names'][player]} joined the game.\n"
-        await query.edit_message_text(
-            text=ctx,
-            reply_markup=InlineKeyboardMarkup(
-                [[InlineKeyboardButton("Join", callback_data="join")]]
-            )
-        )
+        edits.edit(context.bot, chat_id, query.message.message_id,
+                   text=ctx,
+                   reply_markup=InlineKeyboardMarkup(
+                       [[InlineKeyboardButton("Join", callback_data="join")]]
+                   ))
 
 
+@per_table
 async def action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
@@ -537,105 +813,90 @@ async def action_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.data == "hit":
         card = deal_card(game['deck'])
         game['hands'][player_id].append(card)
-        total = calculate_hand_value(game['hands'][player_id])
+        total = game['hands'][player_id].value
         if total > 21:
             text = (f"{game['names'][player_id]} busted with: "
                     f"{format_hand(game['hands'][player_id])} (Total: {total})")
-            await query.edit_message_text(text)
             game['context'] += text
             game['context'] += '\n\n'
             game['current'] += 1
+            edits.edit(context.bot, chat_id, query.message.message_id, text=text)
             await send_next_turn(context, chat_id, None)
         else:
             await send_next_turn(context, chat_id, game['last_turn'])
 
     elif query.data == "stand":
         text = (f"{game['names'][player_id]} stands with: {format_hand(game['hands'][player_id])} "
-                f"(Total: {calculate_hand_value(game['hands'][player_id])})")
-        await query.edit_message_text(text)
+                f"(Total: {game['hands'][player_id].value})")
         game['context'] += text
         game['context'] += '\n\n'
         game['current'] += 1
+        edits.edit(context.bot, chat_id, query.message.message_id, text=text)
         await send_next_turn(context, chat_id, None)
 
 
+@traced('finish_game')
 async def finish_game(context: ContextTypes.DEFAULT_TYPE, chat_id):
     game = games[chat_id]
+    snapshot_game(chat_id, 'dealer')
 
     gemini = game['AI']['hands']
-    gemini_context = (f"Your current cards: {format_hand(gemini)} "
-                      f"(Total: {calculate_hand_value(gemini)})")
-    gemini_context += '\n\n'
+    dealer_up = game['dealer'][0]
 
-    msg = await context.bot.send_message(
-        chat_id=chat_id,
-        text=f"<b>Gemini</b>'s turn\nHand: {format_hand(gemini)} (Total: {calculate_hand_value(gemini)})\n",
-        parse_mode='HTML'
-    )
-    msg_id = msg.message_id
-    prompt = ('You are a Blackjack master. '
-              'Given a hand of cards, your only task is to decide whether to "hit" or '
-              '"stand" based on standard Blackjack strategy. Must only reply with a single word: either "hit" or '
-              '"stand".Do not explain your reasoning or include any other text. '
-              '\nExample input: "Hand: 9♠ 7♦ (Total: 16), '
-              'Dealer shows: 10♥" \nExpected output: hit\n\n')
-
-    while True:
-        reply = await gemini_blackjack(prompt, game['context'] + gemini_context, 0)
-        if 'hit' in reply:
-            gemini.append(deal_card(game['deck']))
-            await context.bot.edit_message_text(
-                text=f"<b>Gemini</b>'s turn\nHand: {format_hand(gemini)} (Total: {calculate_hand_value(gemini)})\n",
-                message_id=msg_id,
-                chat_id=chat_id,
-                parse_mode='HTML'
-            )
-            if calculate_hand_value(gemini) > 21:
-                await context.bot.edit_message_text(
-                    text=(f"Gemini busted with: "
-                          f"{format_hand(gemini)} (Total: {calculate_hand_value(gemini)})"),
-                    message_id=msg_id,
-                    chat_id=chat_id,
-                    parse_mode='HTML'
-                )
+    # Gemini sits the round out when it had no balance left to bet
+    if 'bets' in game['AI']:
+        msg = await context.bot.send_message(
+            chat_id=chat_id,
+            text=f"<b>Gemini</b>'s turn\nHand: {format_hand(gemini)} (Total: {gemini.value})\n",
+            parse_mode='HTML'
+        )
+        msg_id = msg.message_id
+
+        while True:
+            if await gemini_decision(game, gemini, dealer_up) == HIT:
+                gemini.append(deal_card(game['deck']))
+                # Progress edits aren't awaited, so hits decided in quick succession collapse
+                edits.edit(context.bot, chat_id, msg_id,
+                           text=f"<b>Gemini</b>'s turn\nHand: {format_hand(gemini)} (Total: {gemini.value})\n",
+                           parse_mode='HTML')
+                if gemini.value > 21:
+                    await edits.edit(context.bot, chat_id, msg_id,
+                                     text=(f"Gemini busted with: "
+                                           f"{format_hand(gemini)} (Total: {gemini.value})"),
+                                     parse_mode='HTML')
+                    break
+            else:
+                await edits.edit(context.bot, chat_id, msg_id,
+                                 text=(f"Gemini stands with: {format_hand(gemini)} "
+                                       f"(Total: {gemini.value})"),
+                                 parse_mode='HTML')
                 break
-            gemini_context = (f"Your current cards: {format_hand(gemini)} "
-                              f"(Total: {calculate_hand_value(gemini)})")
-            gemini_context += '\n\n'
-        else:
-            await context.bot.edit_message_text(
-                text=(f"Gemini stands with: {format_hand(gemini)} "
-                      f"(Total: {calculate_hand_value(gemini)})"),
-                message_id=msg_id,
-                chat_id=chat_id,
-                parse_mode='HTML'
-            )
-            break
 
     dealer = game['dealer']
-    while calculate_hand_value(dealer) < 17:
+    while dealer.value < 17:
         dealer.append(deal_card(game['deck']))
-    dealer_total = calculate_hand_value(dealer)
+    dealer_total = dealer.value
 
     result = f"Dealer hand: {format_hand(dealer)} (Total: {dealer_total})\n\n"
-    gemini_total = calculate_hand_value(gemini)
-    gemini_bet = game['AI']['bets']
-    if gemini_total > 21:
-        result += f"<b>Gemini</b> busted."
-    elif dealer_total > 21 or gemini_total > dealer_total:
-        result += f"<b>Gemini</b> wins!"
-        balances['AI'] = balances['AI'] + 2 * \
-                         gemini_bet  # Win: get back bet + win amount
-    elif gemini_total == dealer_total:
-        result += f"<b>Gemini</b> ties."
-        balances['AI'] = balances['AI'] + gemini_bet  # Tie: get back bet
-    else:
-        result += f"<b>Gemini</b> loses."
+    if 'bets' in game['AI']:
+        gemini_total = gemini.value
+        gemini_bet = game['AI']['bets']
+        if gemini_total > 21:
+            result += f"<b>Gemini</b> busted."
+        elif dealer_total > 21 or gemini_total > dealer_total:
+            result += f"<b>Gemini</b> wins!"
+            balances['AI'] = balances['AI'] + 2 * \
+                             gemini_bet  # Win: get back bet + win amount
+        elif gemini_total == dealer_total:
+            result += f"<b>Gemini</b> ties."
+            balances['AI'] = balances['AI'] + gemini_bet  # Tie: get back bet
+        else:
+            result += f"<b>Gemini</b> loses."
 
-    result += f" Bet: {gemini_bet}, New Balance: {balances['AI']}\n\n"
+        result += f" Bet: {gemini_bet}, New Balance: {balances['AI']}\n\n"
 
     for pid in game['players']:
-        player_total = calculate_hand_value(game['hands'][pid])
+        player_total = game['hands'][pid].value
         name = game['names'][pid]
         bet = game['bets'].get(pid, 50)
 
@@ -655,12 +916,12 @@ async def finish_game(context: ContextTypes.DEFAULT_TYPE, chat_id):
 
     result += "Game ends. Send /blackjack to start a new game. Send /add_balance to ask AI for points."
     logger.info(f"Blackjack game ends in chat {chat_id}.")
-    save_balances()
+    mark_balances(['AI', *game['players']])
+    end_game(chat_id)
     await context.bot.send_message(
         chat_id=chat_id,
         text=result,
         parse_mode='HTML')
-    del games[chat_id]
 
 
 async def add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, groups=None):
@@ -671,11 +932,12 @@ async def add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, groups
     if chat_id in groups:
         user_nickname = (update.effective_user.first_name or "") + \
                         ' ' + (update.effective_user.last_name or "")
+        await refresh_balances([user_id])
         if user_id in balances:
             balance = balances.get(user_id)
             if balance == 0:
                 prompt = (
-                    f"You are a blackjack game assistant. A player named {user_nickname} currently has a balance of 0. "
+                    f"You are a blackjack game assistant. The player below currently has a balance of 0. "
                     f"Please decide a fair amount of in-game currency to give them so they can continue playing. "
                     f"The amount should be reasonable for someone restarting the game.\n\n"
                     f"Only respond with the number (e.g., 100, 200). The amount can be more aggressive."
@@ -684,12 +946,13 @@ async def add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, groups
                     f"Player: {user_nickname}\n"
                     f"Current balance: 0\n"
                 )
-                reply = await gemini_blackjack(prompt, context_text)
-                reply = reply.strip()
+                reply = await gemini_blackjack(prompt, context_text, priority=PRIORITY_MENTION)
+                reply = (reply or "").strip()
 
                 if re.fullmatch(r"\d+", reply):
                     new_balance = int(reply)
                     balances[user_id] = new_balance
+                    mark_balances([user_id])
                     await update.message.reply_text(
                         f"{user_nickname}, you’ve been given {new_balance} points by Gemini to continue playing!")
                 else:
@@ -708,31 +971,65 @@ async def add_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, groups
     return
 
 
-async def gemini_blackjack(prompt, context, retry_count=0):
-    if retry_count > 3:
-        logger.error("Failed after maximum number of retry times")
-        return
+@traced('gemini_decision')
+async def gemini_decision(game, hand, dealer_up):
+    """Decide whether Gemini hits or stands, following AI_MODE.
+
+    The basic-strategy table answers instantly; the LLM modes fall back to it when the
+    request fails, gives no usable answer or, in the fallback mode, takes longer than
+    AI_TIMEOUT seconds.
+    """
+    total = hand.value
+    decision = basic_strategy(total, hand.soft, card_value(dealer_up))
+    if AI_MODE == 'strategy' or total >= 21:
+        return decision
 
+    prompt = ('You are a Blackjack master. '
+              'Given a hand of cards, your only task is to decide whether to "hit" or '
+              '"stand" based on standard Blackjack strategy. Must only reply with a single word: either "hit" or '
+              '"stand".Do not explain your reasoning or include any other text. '
+              '\nExample input: "Hand: 9♠ 7♦ (Total: 16), '
+              'Dealer shows: 10♥" \nExpected output: hit\n\n')
+    gemini_context = f"Your current cards: {format_hand(hand)} (Total: {total}), Dealer shows: {card_name(dealer_up)}\n\n"
+    request = gemini_blackjack(prompt, game['context'] + gemini_context)
+    try:
+        if AI_MODE == 'llm':
+            reply = await request
+        else:
+            reply = await asyncio.wait_for(request, AI_TIMEOUT)
+    except asyncio.TimeoutError:
+        logger.info(f"Gemini blackjack decision timed out after {AI_TIMEOUT}s, using basic strategy.")
+        return decision
+
+    reply = (reply or "").strip().lower()
+    if 'hit' in reply:
+        return HIT
+    if 'stand' in reply:
+        return STAND
+    logger.warning(f"Unusable blackjack decision {reply!r}, using basic strategy.")
+    return decision
+
+
+@traced('gemini_blackjack')
+async def gemini_blackjack(prompt, context, priority=PRIORITY_GAME):
     context = bleach.clean(context).strip()
     context = "<|im_start|>system\n\n" + context
 
-    try:
-        model = genai.GenerativeModel(model_name="gemini-1.5-flash-latest", safety_settings=SAFETY_SETTINGS,
-                                      system_instruction=prompt)
-        gemini_messages = [{
-            "role": "user",
-            "parts": [{"text": context}]
-        }]
-        response = model.generate_content(gemini_messages)
-        reply_text = response.text
-        logger.info(reply_text)
-
-        return reply_text
+    gemini_messages = [{
+        "role": "user",
+        "parts": [{"text": context}]
+    }]
 
+    try:
+        with measure(gemini_seconds, 'blackjack'):
+            reply_text = await generate_text(prompt, gemini_messages, priority)
     except Exception as e:
-        traceback.print_exc()
-        logger.warning(e)
-        await gemini_blackjack(context, retry_count + 1)
+        logger.error(f"Gemini blackjack request failed ({classify(e)}): {e}")
+        return
+
+    logger.info(reply_text)
+
+    return reply_text
 
 # Main setup
 # def main():
@@ -0,0 +1,67 @@
+import random
+
+# A card is an int in 0..51: suit * 13 + rank
+suits = ['♠', '♥', '♦', '♣']
+ranks = ['A', '2', '3', '4', '5', '6', '7', '8', '9', '10', 'J', 'Q', 'K']
+rank_values = [11, 2, 3, 4, 5, 6, 7, 8, 9, 10, 10, 10, 10]
+
+CARD_NAMES = tuple(f"{rank}{suit}" for suit in suits for rank in ranks)
+CARD_VALUES = tuple(value for _ in suits for value in rank_values)
+ACE = 11
+
+deck_template = list(range(len(CARD_NAMES)))
+
+
+def new_deck():
+    deck = deck_template.copy()
+    random.shuffle(deck)
+    return deck
+
+
+def card_name(card):
+    return CARD_NAMES[card]
+
+
+def card_value(card):
+    return CARD_VALUES[card]
+
+
+class Hand:
+    """Cards of one hand with its blackjack total kept up to date as cards are added."""
+
+    __slots__ = ('cards', 'value', 'soft_aces')
+
+    def __init__(self, cards=()):
+        self.cards = []
+        self.value = 0
+        # Aces currently counted as 11
+        self.soft_aces = 0
+        for card in cards:
+            self.append(card)
+
+    def append(self, card):
+        self.cards.append(card)
+        value = CARD_VALUES[card]
+        self.value += value
+        if value == ACE:
+            self.soft_aces += 1
+        while self.value > 21 and self.soft_aces:
+            self.value -= 10
+            self.soft_aces -= 1
+
+    @property
+    def soft(self):
+        return self.soft_aces > 0
+
+    def __len__(self):
+        return len(self.cards)
+
+    def __iter__(self):
+        return iter(self.cards)
+
+    def __getitem__(self, index):
+        return self.cards[index]
+
+
+def format_hand(hand):
+    return ' '.join(CARD_NAMES[card] for card in hand)
@@ -0,0 +1,97 @@
+import os
+import sqlite3
+import threading
+
+
+# Balance of a player the store has not seen yet
+DEFAULT_BALANCE = 1000
+
+
+def _key(user_id):
+    return 'AI' if user_id == 'AI' else int(user_id)
+
+
+class GameStore:
+    """Player balances and snapshots of open tables in SQLite (WAL mode), one upsert per changed row.
+
+    Balances are written as deltas, so several processes sharing the file never overwrite
+    each other's changes to the same player.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Flushes run in worker threads, so share the connection behind a lock
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Other processes may hold the write lock for a moment
+        self.db.execute("PRAGMA busy_timeout=5000")
+        self.db.execute("CREATE TABLE IF NOT EXISTS balances (user_id TEXT PRIMARY KEY, amount INTEGER NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS games (chat_id INTEGER PRIMARY KEY, state TEXT NOT NULL)")
+
+    def load(self):
+        return {_key(user_id): amount for user_id, amount in self.db.execute("SELECT user_id, amount FROM balances")}
+
+    def get(self, user_ids):
+        user_ids = [str(user_id) for user_id in user_ids]
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT user_id, amount FROM balances WHERE user_id IN ({','.join('?' * len(user_ids))})",
+                user_ids).fetchall()
+        return {_key(user_id): amount for user_id, amount in rows}
+
+    def load_games(self):
+        return dict(self.db.execute("SELECT chat_id, state FROM games"))
+
+    def save(self, deltas, snapshots=None, ended=()):
+        """Add ``{user_id: delta}`` to the balances, write ``{chat_id: state}`` and drop ended tables.
+
+        Everything lands in one transaction, so a game's settlement and the removal of its
+        snapshot happen together or not at all. Returns the new balances of the changed players.
+        """
+        if not deltas and not snapshots and not ended:
+            return {}
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany(
+                "INSERT INTO balances (user_id, amount) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET amount = amount + ?",
+                [(str(user_id), DEFAULT_BALANCE + delta, delta) for user_id, delta in deltas.items()])
+            fresh = {}
+            if deltas:
+                user_ids = [str(user_id) for user_id in deltas]
+                fresh = {_key(user_id): amount for user_id, amount in self.db.execute(
+                    f"SELECT user_id, amount FROM balances WHERE user_id IN ({','.join('?' * len(user_ids))})",
+                    user_ids)}
+            if snapshots:
+                self.db.executemany(
+                    "INSERT INTO games (chat_id, state) VALUES (?, ?) "
+                    "ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state",
+                    list(snapshots.items()))
+            self.db.executemany("DELETE FROM games WHERE chat_id = ?", [(chat_id,) for chat_id in ended])
+        return fresh
+
+    def migrate_text(self, filename):
+        """Import a legacy ``user_id:amount`` file once, then rename it to ``<filename>.migrated``."""
+        if not os.path.exists(filename):
+            return 0
+        if self.db.execute("SELECT 1 FROM balances LIMIT 1").fetchone():
+            return 0
+
+        changes = {}
+        with open(filename, "r") as f:
+            for line in f:
+                if line.strip():
+                    user_id, amount = line.strip().split(":")
+                    changes[_key(user_id)] = int(amount)
+        with self.lock, self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.executemany("INSERT OR REPLACE INTO balances (user_id, amount) VALUES (?, ?)",
+                                [(str(user_id), amount) for user_id, amount in changes.items()])
+        os.replace(filename, filename + ".migrated")
+        return len(changes)
+
+    def close(self):
+        self.db.close()
@@ -0,0 +1,36 @@
+HIT = 'hit'
+STAND = 'stand'
+
+# Dealer up-card values, ace counted as 11
+UP_CARDS = range(2, 12)
+
+
+def _hard(total, up):
+    if total <= 11:
+        return HIT
+    if total == 12:
+        return STAND if 4 <= up <= 6 else HIT
+    if total <= 16:
+        return STAND if up <= 6 else HIT
+    return STAND
+
+
+def _soft(total, up):
+    if total <= 17:
+        return HIT
+    if total == 18:
+        return STAND if up <= 8 else HIT
+    return STAND
+
+
+# Basic strategy for a game without doubling or splitting, indexed [total][up card]
+HARD = {total: {up: _hard(total, up) for up in UP_CARDS} for total in range(4, 22)}
+SOFT = {total: {up: _soft(total, up) for up in UP_CARDS} for total in range(12, 22)}
+
+
+def basic_strategy(total, soft, dealer_up):
+    """Return HIT or STAND for a hand total (soft if an ace still counts as 11) against the dealer's up card."""
+    if total >= 21:
+        return STAND
+    table = SOFT if soft else HARD
+    return table[max(total, min(table))][dealer_up]
@@ -0,0 +1,71 @@
+import asyncio
+
+from telegram.error import BadRequest
+
+from infra.tracing import span
+
+
+class EditCoalescer:
+    """Collapses edits of the same message that arrive within ``window`` seconds into the latest one.
+
+    ``edit`` returns a future for the edit that will actually be sent; awaiting it is optional,
+    so a loop can post progress edits without waiting and only the final state goes out.
+    """
+
+    def __init__(self, window=0.5, logger=None):
+        self.configure(window, logger)
+        self.pending = {}
+        self.tasks = set()
+        self.sent = 0
+        self.coalesced = 0
+
+    def configure(self, window=0.5, logger=None):
+        self.window = window
+        self.logger = logger
+
+    def edit(self, bot, chat_id, message_id, **kwargs):
+        key = (chat_id, message_id)
+        entry = self.pending.get(key)
+        if entry is not None:
+            # The newer rendering replaces the one still waiting
+            entry[1] = kwargs
+            self.coalesced += 1
+            return entry[0]
+
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(self.report)
+        self.pending[key] = [future, kwargs]
+        task = asyncio.create_task(self.send_later(bot, key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return future
+
+    async def send_later(self, bot, key):
+        # Runs in a copy of the editing update's context, so this shows up in its trace
+        with span('edit_window'):
+            await asyncio.sleep(self.window)
+        future, kwargs = self.pending.pop(key)
+        try:
+            result = await bot.edit_message_text(chat_id=key[0], message_id=key[1], **kwargs)
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                future.set_result(None)
+            else:
+                future.set_exception(e)
+            return
+        except Exception as e:
+            future.set_exception(e)
+            return
+        self.sent += 1
+        future.set_result(result)
+
+    def report(self, future):
+        # Nobody may await a progress edit, so log failures here instead of losing them
+        if not future.cancelled() and future.exception() and self.logger:
+            self.logger.warning(f"Message edit failed: {future.exception()}")
+
+    def stats(self):
+        return {'pending': len(self.pending), 'sent': self.sent, 'coalesced': self.coalesced}
+
+
+edits = EditCoalescer()
@@ -0,0 +1,171 @@
+import asyncio
+import bisect
+import functools
+import time
+from contextlib import contextmanager
+
+# Seconds; spans quick Bot API calls up to slow Gemini replies
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        # label values -> count
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {value}"
+
+
+class Histogram:
+    """Observations counted into fixed buckets, so recording one is a bisect and two additions."""
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # label values -> [per-bucket counts (+Inf last), sum, count]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        entry = self.values.get(labels)
+        if entry is None:
+            entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+
+    def render(self):
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket
+                yield f"{self.name}_bucket{_labels((*self.labels, 'le'), (*labels, bound))} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {total}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {count}"
+
+
+class Gauge:
+    """A value read from ``read`` when the metrics are scraped, so it costs nothing in between."""
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.read()}"
+
+
+class MetricsRegistry:
+    """Counters, histograms and gauges of this process, served in the Prometheus text format."""
+
+    def __init__(self):
+        self.metrics = {}
+        self.server = None
+
+    def add(self, metric):
+        # Defining a metric again returns the one already recording
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, read):
+        # A gauge reads live state, so the newest reader wins
+        self.metrics[name] = Gauge(name, help, read)
+        return self.metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    async def serve(self, host="127.0.0.1", port=9464):
+        """Answer every HTTP request on ``host:port`` with the current metrics."""
+        async def respond(reader, writer):
+            try:
+                # Request line and headers; the path does not matter
+                while (await reader.readline()).strip():
+                    pass
+                body = self.render().encode()
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                             b"Content-Length: " + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+                await writer.drain()
+            except ConnectionError:
+                pass
+            finally:
+                writer.close()
+
+        self.server = await asyncio.start_server(respond, host, port)
+        return self.server
+
+
+@contextmanager
+def measure(histogram, *labels):
+    """Observe the duration of the block with ``labels`` and an outcome: "ok" or the exception's name."""
+    started = time.perf_counter()
+    try:
+        yield
+    except BaseException as e:
+        histogram.observe(time.perf_counter() - started, *labels, type(e).__name__)
+        raise
+    histogram.observe(time.perf_counter() - started, *labels, "ok")
+
+
+def timed(histogram, callback, *labels):
+    """Wrap an async callback so each call is measured, see ``measure``."""
+    # Same as measure, without the generator machinery on every update
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await callback(*args, **kwargs)
+        except BaseException as e:
+            histogram.observe(time.perf_counter() - started, *labels, type(e).__name__)
+            raise
+        histogram.observe(time.perf_counter() - started, *labels, "ok")
+        return result
+
+    return wrapper
+
+
+registry = MetricsRegistry()
+
+gemini_seconds = registry.histogram(
+    'gemini_request_seconds', 'Duration of Gemini requests, from queueing to the last chunk.', ('call', 'outcome'))
+telegram_seconds = registry.histogram(
+    'telegram_request_seconds', 'Duration of Bot API calls, without the wait for the rate limiter.',
+    ('endpoint', 'outcome'))
+telegram_wait_seconds = registry.histogram(
+    'telegram_queue_wait_seconds', 'Time Bot API calls waited for the outbound rate limiter.')
+handler_seconds = registry.histogram(
+    'handler_seconds', 'Duration of update handlers.', ('handler', 'outcome'))
+replies = registry.counter('replies_total', 'Gemini replies sent to chats, by priority.', ('kind',))
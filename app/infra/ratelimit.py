@@ -0,0 +1,128 @@
+import asyncio
+import time
+from collections import deque
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from AI.scheduler import TokenBucket
+from infra.metrics import measure, telegram_seconds, telegram_wait_seconds
+from infra.tracing import span
+
+# Requests that put or change a message in a chat, the ones Telegram's flood limits count
+LIMITED_ENDPOINTS = {
+    'sendMessage', 'editMessageText', 'editMessageReplyMarkup', 'deleteMessage', 'sendPhoto', 'sendDocument',
+    'sendSticker', 'sendAnimation', 'sendVoice', 'sendVideo', 'sendAudio', 'copyMessage', 'forwardMessage',
+}
+
+
+class ChatQueue:
+    def __init__(self, rate, burst):
+        self.bucket = TokenBucket(rate, burst)
+        # asyncio.Lock wakes waiters in arrival order, so each chat's messages keep their order
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0
+
+
+class OutboundLimiter(BaseRateLimiter):
+    """Spaces out Bot API calls under a global messages/sec limit and a per-chat limit.
+
+    Group chats get ``group_rpm`` messages a minute, private chats ``private_rate`` a second,
+    and all chats together ``global_rate`` a second. A RetryAfter from Telegram pauses the
+    chat for the requested time and the call is retried up to ``max_retries`` times.
+    """
+
+    def __init__(self, global_rate=30, group_rpm=20, private_rate=1, max_retries=3):
+        self.configure(global_rate, group_rpm, private_rate, max_retries)
+        self.global_lock = asyncio.Lock()
+        self.waiting = 0
+        self.sent = 0
+        self.retries = 0
+        self.waits = deque(maxlen=500)
+
+    def configure(self, global_rate=30, group_rpm=20, private_rate=1, max_retries=3):
+        self.global_rate = global_rate
+        self.group_rpm = group_rpm
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        # A burst under one token would never let a call through
+        self.global_bucket = TokenBucket(global_rate, max(1, global_rate))
+        self.chats = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def chat_queue(self, chat_id):
+        queue = self.chats.get(chat_id)
+        if queue is None:
+            if isinstance(chat_id, str) or chat_id < 0:
+                queue = ChatQueue(self.group_rpm / 60, max(1, self.group_rpm))
+            else:
+                queue = ChatQueue(self.private_rate, max(1, self.private_rate))
+            self.chats[chat_id] = queue
+        return queue
+
+    @staticmethod
+    async def take(bucket, queue=None):
+        while True:
+            paused_for = queue.paused_until - time.monotonic() if queue else 0
+            delay = paused_for if paused_for > 0 else bucket.take()
+            if not delay:
+                return
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    async def call(callback, args, kwargs, endpoint):
+        with span(endpoint), measure(telegram_seconds, endpoint):
+            return await callback(*args, **kwargs)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        if endpoint not in LIMITED_ENDPOINTS or chat_id is None:
+            return await self.call(callback, args, kwargs, endpoint)
+
+        queue = self.chat_queue(chat_id)
+        for attempt in range(self.max_retries + 1):
+            queued_at = time.monotonic()
+            self.waiting += 1
+            try:
+                with span('telegram_wait'):
+                    async with queue.lock:
+                        await self.take(queue.bucket, queue)
+                        async with self.global_lock:
+                            await self.take(self.global_bucket)
+            finally:
+                self.waiting -= 1
+            self.waits.append(time.monotonic() - queued_at)
+            telegram_wait_seconds.observe(self.waits[-1])
+
+            try:
+                result = await self.call(callback, args, kwargs, endpoint)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retries += 1
+                retry_after = e.retry_after
+                if hasattr(retry_after, 'total_seconds'):
+                    retry_after = retry_after.total_seconds()
+                queue.paused_until = max(queue.paused_until, time.monotonic() + retry_after)
+
+    def stats(self):
+        waits = sorted(self.waits)
+        return {
+            'waiting': self.waiting,
+            'sent': self.sent,
+            'retries': self.retries,
+            'chats': len(self.chats),
+            'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+            'wait_p95': waits[int(len(waits) * 0.95)] if waits else 0.0,
+            'wait_max': waits[-1] if waits else 0.0,
+        }
+
+
+limiter = OutboundLimiter()
@@ -0,0 +1,137 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import os
+import signal
+import struct
+
+from telegram import Update
+
+# Updates travel between the dispatcher and the workers as a 4-byte length and the JSON body
+HEADER = struct.Struct('>I')
+
+
+class HashRing:
+    """Consistent hashing of chat ids onto worker shards."""
+
+    def __init__(self, shards, replicas=64):
+        self.shards = shards
+        self.ring = sorted((self.hash(f"{shard}:{replica}"), shard)
+                           for shard in range(shards) for replica in range(replicas))
+        self.points = [point for point, _ in self.ring]
+
+    @staticmethod
+    def hash(value):
+        return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+    def shard(self, chat_id):
+        index = bisect.bisect(self.points, self.hash(chat_id)) % len(self.points)
+        return self.ring[index][1]
+
+
+def update_chat_id(update):
+    """Find the chat an update belongs to, falling back to the sender for updates without one."""
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        if 'chat' in value:
+            return value['chat']['id']
+        if 'message' in value and 'chat' in value['message']:
+            return value['message']['chat']['id']
+        if 'from' in value:
+            return value['from']['id']
+    return 0
+
+
+def socket_path(directory, shard):
+    return os.path.join(directory, f"worker-{shard}.sock")
+
+
+async def read_frames(reader):
+    while True:
+        try:
+            header = await reader.readexactly(HEADER.size)
+            body = await reader.readexactly(HEADER.unpack(header)[0])
+        except asyncio.IncompleteReadError:
+            return
+        yield json.loads(body)
+
+
+class Dispatcher:
+    """Webhook receiver that forwards each update to the worker owning its chat over a unix socket."""
+
+    def __init__(self, shards, directory, secret_token, logger):
+        self.ring = HashRing(shards)
+        self.directory = directory
+        self.secret_token = secret_token
+        self.logger = logger
+        self.writers = {}
+        self.locks = {shard: asyncio.Lock() for shard in range(shards)}
+        self.forwarded = [0] * shards
+
+    async def writer(self, shard):
+        writer = self.writers.get(shard)
+        if writer is None or writer.is_closing():
+            _, writer = await asyncio.open_unix_connection(socket_path(self.directory, shard))
+            self.writers[shard] = writer
+        return writer
+
+    async def forward(self, body):
+        """Send the raw update to its worker; False if the worker can't take it right now."""
+        update = json.loads(body)
+        shard = self.ring.shard(update_chat_id(update))
+        async with self.locks[shard]:
+            try:
+                writer = await self.writer(shard)
+                writer.write(HEADER.pack(len(body)) + body)
+                await writer.drain()
+            except OSError as e:
+                self.writers.pop(shard, None)
+                self.logger.warning(f"Worker {shard} unavailable, Telegram will retry the update: {e}")
+                return False
+        self.forwarded[shard] += 1
+        return True
+
+    def make_app(self, path):
+        from tornado.web import Application, RequestHandler
+
+        dispatcher = self
+
+        class WebhookHandler(RequestHandler):
+            async def post(self):
+                if self.request.headers.get('X-Telegram-Bot-Api-Secret-Token') != dispatcher.secret_token:
+                    self.set_status(403)
+                    return
+                # A non-200 answer makes Telegram deliver the update again later
+                if not await dispatcher.forward(self.request.body):
+                    self.set_status(503)
+
+        return Application([(f"/{path.strip('/')}", WebhookHandler)])
+
+
+async def serve_worker(app, path, logger, on_stop=None):
+    """Run a bot Application that takes its updates from the dispatcher over a unix socket."""
+    async def receive(reader, writer):
+        async for data in read_frames(reader):
+            await app.update_queue.put(Update.de_json(data, app.bot))
+        writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+
+    async with app:
+        await app.start()
+        server = await asyncio.start_unix_server(receive, path)
+        logger.info(f"Worker {os.getpid()} listening on {path}.")
+        try:
+            await stop.wait()
+        finally:
+            server.close()
+            await app.stop()
+            if on_stop:
+                on_stop()
@@ -0,0 +1,197 @@
+import asyncio
+import functools
+import json
+import threading
+import time
+from collections import deque
+from contextvars import ContextVar
+
+# (trace, depth, id) of the innermost open span; tasks created inside a trace inherit it
+_current = ContextVar('trace', default=None)
+
+
+class Trace:
+    def __init__(self, name, update_id=None, chat_id=None):
+        self.name = name
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.at = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        # (name, start offset, duration, depth, id, parent id), in the order the spans end; the trace is id 0
+        self.spans = []
+        self.last_id = 0
+
+    def add(self, name, started, depth, span_id, parent):
+        self.spans.append((name, started - self.started, time.perf_counter() - started, depth, span_id, parent))
+
+    def breakdown(self):
+        lines = [f"{self.name} (update {self.update_id}, chat {self.chat_id}): {self.duration * 1000:.1f}ms"]
+        children = {}
+        for entry in sorted(self.spans, key=lambda s: s[1]):
+            children.setdefault(entry[5], []).append(entry)
+        stack = list(reversed(children.get(0, [])))
+        while stack:
+            name, offset, duration, depth, span_id, _ = stack.pop()
+            lines.append(f"{'  ' * depth}{name} {duration * 1000:.1f}ms at +{offset * 1000:.1f}ms")
+            stack.extend(reversed(children.get(span_id, [])))
+        return "\n".join(lines)
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'update_id': self.update_id,
+            'chat_id': self.chat_id,
+            'at': self.at,
+            'ms': round(self.duration * 1000, 3),
+            'spans': [{'name': name, 'at_ms': round(offset * 1000, 3), 'ms': round(duration * 1000, 3),
+                       'id': span_id, 'parent': parent}
+                      for name, offset, duration, _, span_id, parent in self.spans],
+        }
+
+
+class Span:
+    """Times a block as part of the current trace; does nothing outside of one."""
+
+    __slots__ = ('name', 'trace', 'depth', 'id', 'parent', 'token', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.trace = None
+
+    def __enter__(self):
+        current = _current.get()
+        # A task can outlive the trace it was started in
+        if current is not None and current[0].duration is None:
+            self.trace, depth, self.parent = current
+            self.depth = depth + 1
+            self.trace.last_id += 1
+            self.id = self.trace.last_id
+            self.token = _current.set((self.trace, self.depth, self.id))
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            _current.reset(self.token)
+            self.trace.add(self.name, self.started, self.depth, self.id, self.parent)
+        return False
+
+
+class RootSpan:
+    """Starts a trace, or becomes a span when one is already open."""
+
+    __slots__ = ('tracer', 'name', 'update_id', 'chat_id', 'span', 'trace', 'token')
+
+    def __init__(self, tracer, name, update_id=None, chat_id=None):
+        self.tracer = tracer
+        self.name = name
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.span = None
+
+    def __enter__(self):
+        current = _current.get()
+        if current is not None and current[0].duration is None:
+            self.span = Span(self.name).__enter__()
+            return self.span
+        self.trace = Trace(self.name, self.update_id, self.chat_id)
+        self.token = _current.set((self.trace, 0, 0))
+        return self
+
+    def __exit__(self, *exc):
+        if self.span is not None:
+            return self.span.__exit__(*exc)
+        _current.reset(self.token)
+        self.trace.duration = time.perf_counter() - self.trace.started
+        self.tracer.finish(self.trace)
+        return False
+
+
+class Tracer:
+    """Keeps the last ``size`` traces and dumps every trace slower than ``slow`` seconds.
+
+    Slow traces go to the logger with their breakdown and, when ``path`` is set, as one JSON
+    object per line to that file. The file is appended to from the loop's default executor.
+    """
+
+    def __init__(self, slow=5.0, size=200, path=None, logger=None):
+        self.configure(slow, size, path, logger)
+        # Appends from several executor threads must not interleave
+        self.file_lock = threading.Lock()
+
+    def configure(self, slow=5.0, size=200, path=None, logger=None):
+        self.slow = slow
+        self.recent = deque(maxlen=size)
+        self.path = path
+        self.logger = logger
+
+    def trace(self, name, update_id=None, chat_id=None):
+        return RootSpan(self, name, update_id, chat_id)
+
+    def finish(self, trace):
+        self.recent.append(trace)
+        if self.slow is not None and trace.duration >= self.slow:
+            self.dump(trace)
+
+    def dump(self, trace):
+        if self.logger:
+            self.logger.warning(f"Slow trace {trace.breakdown()}")
+        if self.path:
+            line = json.dumps(trace.as_dict(), separators=(',', ':')) + "\n"
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.write(self.path, line)
+                return
+            loop.run_in_executor(None, self.write, self.path, line).add_done_callback(self.report)
+
+    def write(self, path, line):
+        with self.file_lock, open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+    def report(self, future):
+        if not future.cancelled() and future.exception() and self.logger:
+            self.logger.warning(f"Could not write slow trace: {future.exception()}")
+
+    def slowest(self, count=5):
+        return sorted(self.recent, key=lambda t: t.duration, reverse=True)[:count]
+
+
+def span(name):
+    return Span(name)
+
+
+def record(name, started):
+    """Add a span that began at ``started`` (``time.perf_counter()``) and ends now."""
+    current = _current.get()
+    if current is not None and current[0].duration is None:
+        trace, depth, parent = current
+        trace.last_id += 1
+        trace.add(name, started, depth + 1, trace.last_id, parent)
+
+
+def traced(name):
+    """Run an update handler or job callback in a trace named ``name``.
+
+    The update id and chat are taken from the Update, or the job, the callback is called with;
+    inside another trace the callback becomes one of its spans.
+    """
+    def decorate(callback):
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            update_id = chat_id = None
+            if args and hasattr(args[0], 'update_id'):
+                update_id = args[0].update_id
+                chat_id = args[0].effective_chat.id if args[0].effective_chat else None
+            elif args and getattr(args[0], 'job', None) is not None:
+                chat_id = args[0].job.chat_id
+            with tracer.trace(name, update_id, chat_id):
+                return await callback(*args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+
+tracer = Tracer()
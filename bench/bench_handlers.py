@@ -0,0 +1,415 @@
+"""End-to-end throughput benchmark of the bot's handlers.
+
+Synthetic updates are fed through the handlers registered by ``bot.add_handlers``
+against a local fake Bot API and the fake LLM backend, so neither a Telegram token
+nor a Gemini key is needed. Results are written as JSON for comparison between
+releases::
+
+    python bench/bench_handlers.py --out bench_results.json
+    python bench/bench_handlers.py --scenario chat --groups 200 --mention-rate 0.05
+    python bench/bench_handlers.py --scenario concurrency --concurrent 20
+    python bench/bench_handlers.py --scenario stream --chunk-size 20 --chunk-delay 0.05
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import resource
+import sys
+import tempfile
+import time
+import types
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "app"), ROOT]
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+
+from fake_telegram import FakeBotApi, message_update, callback_update  # noqa: E402
+from game.cards import card_value, ACE  # noqa: E402
+
+BOT_NICKNAME = "@bench_bot"
+
+
+def bench_config(log_path, args):
+    return {
+        "log": log_path,
+        "bot_token": "1:bench",
+        "persona": [{"t": "Bench", "n": "Bench", "p": "You are {k}, chatting with {n} in {m}."},
+                    {"t": "Terse", "n": "Bench", "p": "You are {k}. Answer {n} in {m} in one sentence."}],
+        "key": "bench-key-1|bench-key-2",
+        "admin": 1,
+        "bot_nickname": [BOT_NICKNAME, BOT_NICKNAME],
+        "groups": [-1],
+        "model": ["bench-model"],
+        "backend": "fake",
+        "fake_backend": {
+            "latency": {"dist": "lognormal", "median": args.llm_latency, "sigma": 0.4},
+            "seed": args.seed,
+        },
+        "gemini_concurrency": args.llm_concurrency,
+        "gemini_rpm": 10 ** 6,
+    }
+
+
+def load_bot(args, workdir):
+    """Import bot.py with a generated config instead of app/config/config.py."""
+    config_module = types.ModuleType("config.config")
+    config_module.bot = bench_config(os.path.join(workdir, "bench.log"), args)
+    sys.modules["config.config"] = config_module
+
+    import bot
+    from game import blackjack
+
+    # load_balances() and save_balances() use paths relative to the working directory
+    os.makedirs(os.path.join(workdir, "app", "data"))
+    os.chdir(workdir)
+    bot.load_config()
+    bot.logger.setLevel("WARNING")
+
+    blackjack.JOIN_WINDOW = args.phase_window
+    blackjack.BET_WINDOW = args.phase_window
+    blackjack.INSURANCE_WINDOW = args.phase_window
+    rig_insurance(blackjack, args)
+    return bot, blackjack
+
+
+def rig_insurance(blackjack, args):
+    """Deal the dealer an Ace face up at a share of the tables, so the insurance phase gets played."""
+    new_deck = blackjack.new_deck
+
+    def deck():
+        cards = new_deck()
+        if random.random() < args.insurance_rate:
+            # Cards are popped from the end: two per player, then the dealer's visible card
+            dealer_up = len(cards) - 1 - 2 * args.players
+            ace = next(i for i, card in enumerate(cards) if card_value(card) == ACE)
+            cards[dealer_up], cards[ace] = cards[ace], cards[dealer_up]
+        return cards
+
+    blackjack.new_deck = deck
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def summarize(latencies):
+    values = [v for samples in latencies.values() for v in samples]
+    return {
+        "p50": percentile(values, 0.50) * 1000,
+        "p95": percentile(values, 0.95) * 1000,
+        "p99": percentile(values, 0.99) * 1000,
+        "max": max(values, default=0.0) * 1000,
+    }
+
+
+class Driver:
+    def __init__(self, app):
+        self.app = app
+        self.latencies = defaultdict(list)
+        self.errors = 0
+        self.stuck_tables = 0
+        self.tasks = set()
+
+    async def process(self, kind, data):
+        update = Update.de_json(data, self.app.bot)
+        started = time.perf_counter()
+        await self.app.process_update(update)
+        self.latencies[kind].append(time.perf_counter() - started)
+
+    def submit(self, kind, data):
+        self.spawn(self.process(kind, data))
+
+    def spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def drain(self):
+        while self.tasks:
+            await asyncio.gather(*list(self.tasks))
+
+
+async def select_persona(driver, chat_id, user_id, index):
+    # /select opens a per-user conversation that the button press closes
+    await driver.process("select", message_update(chat_id, user_id, "/select"))
+    await driver.process("select_persona", callback_update(chat_id, user_id, str(index)))
+
+
+async def chat_scenario(bot, driver, args):
+    groups = [-(1000 + i) for i in range(args.groups)]
+    bot.groups[:] = groups
+    interval = 1 / args.rate
+    for i in range(args.messages):
+        chat_id = random.choice(groups)
+        user_id = random.randint(2, 10 ** 6)
+        if random.random() < args.select_rate:
+            driver.spawn(select_persona(driver, chat_id, user_id, random.randrange(len(bot.persona))))
+        elif random.random() < args.mention_rate:
+            driver.submit("mention", message_update(chat_id, user_id, f"{BOT_NICKNAME} what do you think? #{i}"))
+        else:
+            driver.submit("message", message_update(chat_id, user_id, f"just chatting #{i}"))
+        await asyncio.sleep(interval)
+    await driver.drain()
+
+
+async def open_table(blackjack, driver, chat_id, players):
+    """Start a table, join ``players`` and place their bets."""
+    await driver.process("blackjack", message_update(chat_id, players[0], "/blackjack"))
+    await asyncio.gather(*[driver.process("join", callback_update(chat_id, pid, "join")) for pid in players])
+
+    # The bet buttons exist once send_bet has posted the bet message
+    await asyncio.sleep(blackjack.JOIN_WINDOW)
+    while chat_id in blackjack.games and not blackjack.games[chat_id]['bet_message_id']:
+        await asyncio.sleep(0.05)
+    for _ in range(3):
+        for pid in players:
+            driver.submit("bet", callback_update(chat_id, pid, random.choice(["bet_50", "bet_100", "bet_2x"])))
+        await asyncio.sleep(0.01)
+
+
+async def play_table(blackjack, driver, chat_id, players, timeout):
+    started = time.monotonic()
+    await open_table(blackjack, driver, chat_id, players)
+
+    insured = False
+    while chat_id in blackjack.games:
+        if time.monotonic() - started > timeout:
+            driver.stuck_tables += 1
+            del blackjack.games[chat_id]
+            return
+        game = blackjack.games[chat_id]
+        if game.get('insurance_message_id') and not insured:
+            insured = True
+            for pid in players:
+                driver.submit("insurance", callback_update(
+                    chat_id, pid, random.choice(["insurance_yes", "insurance_no"]), game['insurance_message_id']))
+        pid = game['players'][game['current']] if game.get('current', len(game['players'])) < len(game['players']) else None
+        # A turn is open once send_next_turn has armed the player's timeout job
+        if pid in game['jobs']:
+            await driver.process("action", callback_update(chat_id, pid, random.choice(["hit", "stand"])))
+        await asyncio.sleep(0.05)
+
+
+async def blackjack_scenario(bot, blackjack, driver, args):
+    tables = [-(5000 + i) for i in range(args.tables)]
+    bot.groups[:] = tables
+    next_player = iter(range(2, 10 ** 6))
+    await asyncio.gather(*[
+        play_table(blackjack, driver, chat_id, [next(next_player) for _ in range(args.players)], args.table_timeout)
+        for chat_id in tables])
+    await driver.drain()
+
+
+async def concurrency_scenario(bot, blackjack, driver, args):
+    """One mention on its own, then ``--concurrent`` mentions in as many groups at once, and a double Stand.
+
+    With updates processed concurrently the mentions together take about as long as one;
+    the Stand pressed twice at once must still only pass the turn once. ``failures`` lists
+    which of the two did not hold, and main() exits non-zero when there are any.
+    """
+    from AI.backend import backend
+    latency, backend.latency = backend.latency, {"dist": "fixed", "value": args.llm_latency}
+    groups = [-(9000 + i) for i in range(args.concurrent + 1)]
+    bot.groups[:] = groups
+    try:
+        started = time.perf_counter()
+        await driver.process("mention", message_update(groups[0], 2, f"{BOT_NICKNAME} what do you think?"))
+        single = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await asyncio.gather(*[
+            driver.process("mention", message_update(chat_id, 3 + i, f"{BOT_NICKNAME} what do you think? #{i}"))
+            for i, chat_id in enumerate(groups[1:])])
+        together = time.perf_counter() - started
+    finally:
+        backend.latency = latency
+
+    chat_id = groups[0]
+    players = [2, 3, 4]
+    await open_table(blackjack, driver, chat_id, players)
+    deadline = time.monotonic() + args.table_timeout
+    while players[0] not in blackjack.games[chat_id]['jobs'] and time.monotonic() < deadline:
+        await asyncio.sleep(0.01)
+    await asyncio.gather(*[driver.process("action", callback_update(chat_id, players[0], "stand"))
+                           for _ in range(2)])
+    advanced = blackjack.games[chat_id]['current'] if chat_id in blackjack.games else None
+    blackjack.games.pop(chat_id, None)
+    await driver.drain()
+
+    failures = []
+    if together / single > args.max_slowdown:
+        failures.append(f"{args.concurrent} concurrent mentions took {together / single:.2f}x as long as one "
+                        f"(at most {args.max_slowdown}x)")
+    if advanced != 1:
+        failures.append(f"a double Stand passed {advanced} turns instead of 1")
+    return {
+        "single_mention_s": single,
+        "concurrent_mentions": args.concurrent,
+        "concurrent_mentions_s": together,
+        "slowdown": together / single,
+        # 1 when the second Stand was ignored, 2 when both passed the turn
+        "double_stand_turns": advanced,
+        "failures": failures,
+    }
+
+
+async def stream_scenario(bot, driver, api, args):
+    """Mentions answered with streamed replies, timed to the first sendMessage and to the last edit of each."""
+    from AI.backend import backend
+    settings = bot.stream, bot.stream_interval, backend.chunk_size, backend.chunk_delay
+    bot.stream, bot.stream_interval = True, args.stream_interval
+    backend.chunk_size, backend.chunk_delay = args.chunk_size, args.chunk_delay
+    groups = [-(12000 + i) for i in range(args.stream_mentions)]
+    bot.groups[:] = groups
+    submitted = {}
+    try:
+        for i, chat_id in enumerate(groups):
+            submitted[chat_id] = time.perf_counter()
+            driver.submit("stream_mention", message_update(chat_id, 2 + i, f"{BOT_NICKNAME} tell me more #{i}"))
+            await asyncio.sleep(1 / args.rate)
+        await driver.drain()
+    finally:
+        bot.stream, bot.stream_interval, backend.chunk_size, backend.chunk_delay = settings
+
+    first_message, last_edit = [], []
+    for chat_id in groups:
+        if ("sendMessage", chat_id) not in api.first_call:
+            continue
+        first_message.append(api.first_call[("sendMessage", chat_id)] - submitted[chat_id])
+        # A reply that fits in one chunk is never edited
+        last = api.last_call.get(("editMessageText", chat_id), api.last_call[("sendMessage", chat_id)])
+        last_edit.append(last - submitted[chat_id])
+    return {
+        "streamed_replies": len(first_message),
+        "first_message_ms": summarize({"": first_message}),
+        "last_edit_ms": summarize({"": last_edit}),
+    }
+
+
+async def run_scenario(name, args, bot, blackjack):
+    api = FakeBotApi(latency=args.api_latency)
+    app = (Application.builder().token("1:bench").request(api).get_updates_request(FakeBotApi())
+           .concurrent_updates(True).updater(None).build())
+    bot.add_handlers(app)
+    blackjack.schedule_flush(app.job_queue)
+
+    driver = Driver(app)
+    app.error_handlers.clear()
+
+    async def count_error(update, context):
+        driver.errors += 1
+        if driver.errors <= 5:
+            print(f"handler error: {context.error!r}", file=sys.stderr)
+
+    app.add_error_handler(count_error)
+
+    from AI.backend import backend
+    llm_before = backend.requests
+
+    extra = {}
+    async with app:
+        await app.start()
+        started = time.perf_counter()
+        if name == "chat":
+            await chat_scenario(bot, driver, args)
+        elif name == "concurrency":
+            extra = await concurrency_scenario(bot, blackjack, driver, args)
+        elif name == "stream":
+            extra = await stream_scenario(bot, driver, api, args)
+        else:
+            await blackjack_scenario(bot, blackjack, driver, args)
+        elapsed = time.perf_counter() - started
+        await app.stop()
+
+    updates = sum(len(v) for v in driver.latencies.values())
+    return extra | {
+        "updates": updates,
+        "elapsed_s": elapsed,
+        "updates_per_s": updates / elapsed if elapsed else 0.0,
+        "latency_ms": summarize(driver.latencies),
+        "latency_ms_by_kind": {kind: summarize({kind: v}) | {"count": len(v)}
+                               for kind, v in sorted(driver.latencies.items())},
+        "errors": driver.errors,
+        "stuck_tables": driver.stuck_tables,
+        "bot_api_calls": dict(api.calls),
+        "llm_requests": backend.requests - llm_before,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=["chat", "blackjack", "concurrency", "stream", "all"], default="all")
+    parser.add_argument("--out", default="bench_results.json", help="JSON file to write the results to")
+    parser.add_argument("--groups", type=int, default=200)
+    parser.add_argument("--messages", type=int, default=4000)
+    parser.add_argument("--rate", type=float, default=400, help="offered group messages per second")
+    parser.add_argument("--mention-rate", type=float, default=0.05)
+    parser.add_argument("--select-rate", type=float, default=0.002, help="share of messages that are a /select")
+    parser.add_argument("--concurrent", type=int, default=20, help="mentions sent at once by --scenario concurrency")
+    parser.add_argument("--max-slowdown", type=float, default=1.5,
+                        help="fail when the concurrent mentions take longer than this many times one mention")
+    parser.add_argument("--stream-mentions", type=int, default=50, help="mentions answered by --scenario stream")
+    parser.add_argument("--stream-interval", type=float, default=0.2, help="seconds between edits of a streamed reply")
+    parser.add_argument("--chunk-size", type=int, default=20, help="characters per fake streamed chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.05, help="seconds between fake streamed chunks")
+    parser.add_argument("--tables", type=int, default=50)
+    parser.add_argument("--players", type=int, default=3)
+    parser.add_argument("--insurance-rate", type=float, default=0.2,
+                        help="share of tables where the dealer shows an Ace")
+    parser.add_argument("--table-timeout", type=float, default=120, help="seconds before a table counts as stuck")
+    parser.add_argument("--phase-window", type=float, default=0.5, help="seconds for the join/bet phases")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="median fake LLM latency in seconds")
+    parser.add_argument("--llm-concurrency", type=int, default=32)
+    parser.add_argument("--api-latency", type=float, default=0.005, help="fake Bot API latency in seconds")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    out = os.path.abspath(args.out)
+
+    random.seed(args.seed)
+    with tempfile.TemporaryDirectory() as workdir:
+        bot, blackjack = load_bot(args, workdir)
+        scenarios = ["chat", "blackjack", "concurrency", "stream"] if args.scenario == "all" else [args.scenario]
+        results = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "args": vars(args),
+            "scenarios": {name: asyncio.run(run_scenario(name, args, bot, blackjack)) for name in scenarios},
+        }
+
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+    for name, result in results["scenarios"].items():
+        latency = result["latency_ms"]
+        print(f"{name}: {result['updates']} updates, {result['updates_per_s']:.0f} updates/s, "
+              f"p50 {latency['p50']:.1f}ms p95 {latency['p95']:.1f}ms p99 {latency['p99']:.1f}ms, "
+              f"{result['errors']} errors, {result['stuck_tables']} stuck tables, peak RSS {result['peak_rss_mb']:.0f} MB")
+    if "concurrency" in results["scenarios"]:
+        result = results["scenarios"]["concurrency"]
+        print(f"concurrency: 1 mention in {result['single_mention_s']:.2f}s, {result['concurrent_mentions']} at once "
+              f"in {result['concurrent_mentions_s']:.2f}s ({result['slowdown']:.2f}x), "
+              f"double Stand passed {result['double_stand_turns']} turn(s)")
+    if "stream" in results["scenarios"]:
+        result = results["scenarios"]["stream"]
+        print(f"stream: {result['streamed_replies']} replies, first message p50 {result['first_message_ms']['p50']:.0f}ms "
+              f"p95 {result['first_message_ms']['p95']:.0f}ms, last edit p50 {result['last_edit_ms']['p50']:.0f}ms "
+              f"p95 {result['last_edit_ms']['p95']:.0f}ms")
+    print(f"Results written to {out}")
+    failures = results["scenarios"].get("concurrency", {}).get("failures")
+    if failures:
+        for failure in failures:
+            print(f"FAILED: {failure}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Cost of assembling the history part of the prompt for each mention, by history size.
+
+Each mention appends a message to a full history buffer and assembles the prompt context,
+once the way it was done before history entries were rendered on append (every entry
+formatted and the whole context run through bleach.clean per mention) and once with
+construct_context joining the fragments sanitized on append::
+
+    python bench/bench_history.py --sizes 15 100 1000 --mentions 20
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "app"), ROOT]
+
+import bleach  # noqa: E402
+
+from AI import gemini  # noqa: E402
+from AI.history import ChatHistory  # noqa: E402
+
+CHAT_ID = -1
+MESSAGE = "A group message of a typical length, with <b>some</b> markup & an ampersand to escape. " * 7
+
+
+def construct_context_before(history, chat_id):
+    """construct_context and the sanitizing in gemini_reply as they were before entries were rendered on append."""
+    context_str = f'[system](#context)\nSome history messages in the group are:\n\n'
+    for m in history.get(chat_id):
+        if m['username'] == "FROM_BOT":
+            context = f"You replied {m['user_input']}"
+            context += "\n"
+        else:
+            context = f"User {m['username']} sent a message"
+            if m['user_input'] != "":
+                context += f", the content is {m['user_input']}"
+            context += "\n"
+        context_str += context
+    return bleach.clean(context_str).strip()
+
+
+def before(size, mentions):
+    history = ChatHistory(size=size)
+    for i in range(size):
+        history.append(CHAT_ID, f"user{i % 7}", MESSAGE)
+    started = time.perf_counter()
+    for i in range(mentions):
+        history.append(CHAT_ID, f"user{i % 7}", MESSAGE)
+        construct_context_before(history, CHAT_ID)
+    return time.perf_counter() - started
+
+
+def after(size, mentions):
+    gemini.configure_history(size=size)
+    for i in range(size):
+        gemini.history.append(CHAT_ID, f"user{i % 7}", MESSAGE)
+    started = time.perf_counter()
+    for i in range(mentions):
+        gemini.history.append(CHAT_ID, f"user{i % 7}", MESSAGE)
+        gemini.construct_context(CHAT_ID).strip()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[15, 100, 1000])
+    parser.add_argument("--mentions", type=int, default=20)
+    parser.add_argument("--out", default="history_results.json")
+    args = parser.parse_args()
+
+    sizes = {}
+    for size in args.sizes:
+        sizes[size] = {
+            "before_ms_per_mention": before(size, args.mentions) / args.mentions * 1000,
+            "after_ms_per_mention": after(size, args.mentions) / args.mentions * 1000,
+        }
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "args": vars(args),
+        "sizes": sizes,
+    }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    for size, result in sizes.items():
+        print(f"{size} entries: {result['before_ms_per_mention']:.3f}ms -> "
+              f"{result['after_ms_per_mention']:.3f}ms per mention")
+    print(f"Results written to {os.path.abspath(args.out)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Handler latency under log-heavy load, with and without the queue-based logger.
+
+Simulated handlers log what the real ones log for a reply (the incoming message, the
+prompt and a long reply text) while many of them run concurrently, once with the file
+and console handlers called on the event loop and once with the records handed to the
+listener thread. Console output goes to a file in a temporary directory::
+
+    python bench/bench_logging.py --handlers 20000 --concurrency 50
+    python bench/bench_logging.py --format json --max-bytes 262144
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "app"), ROOT]
+
+from app.config import logger_config  # noqa: E402
+from app.config.logger_config import logger, setup_logger, log_message, stop_logging  # noqa: E402
+from bench_handlers import percentile  # noqa: E402
+
+REPLY = "A reply of a typical length from the model, logged in full by the handler. " * 20
+
+
+async def handler(i, latencies):
+    # Time the handler's own work, not the other handlers that run while it yields
+    started = time.perf_counter()
+    log_message(f"user{i % 97}", "Bench group", False, 'text', f"@bench_bot question number {i}")
+    logger.info(f"Prompt for chat -1: user{i % 97}: question number {i}")
+    spent = time.perf_counter() - started
+    await asyncio.sleep(0)
+    started = time.perf_counter()
+    logger.info(f"Gemini reply: {REPLY}")
+    log_message("bench_bot", "Bench group", True, 'text', REPLY)
+    latencies.append(spent + time.perf_counter() - started)
+
+
+async def lag_probe(lags, done):
+    loop = asyncio.get_running_loop()
+    while not done.is_set():
+        expected = loop.time() + 0.01
+        await asyncio.sleep(0.01)
+        lags.append(max(0.0, loop.time() - expected))
+
+
+async def run(args):
+    latencies, lags = [], []
+    done = asyncio.Event()
+    probe = asyncio.create_task(lag_probe(lags, done))
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def limited(i):
+        async with semaphore:
+            await handler(i, latencies)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(limited(i) for i in range(args.handlers)))
+    elapsed = time.perf_counter() - started
+    done.set()
+    await probe
+    return latencies, lags, elapsed
+
+
+def run_mode(use_queue, args, workdir):
+    stderr = sys.stderr
+    # The console handler binds sys.stderr when it is created
+    sys.stderr = open(os.path.join(workdir, f"console-{use_queue}.log"), "w")
+    try:
+        setup_logger(os.path.join(workdir, f"bot-{use_queue}.log"), max_bytes=args.max_bytes,
+                     backups=args.backups, fmt=args.format, use_queue=use_queue)
+        latencies, lags, elapsed = asyncio.run(run(args))
+        drain_started = time.perf_counter()
+        stop_logging()
+        drain = time.perf_counter() - drain_started
+        for handler in logger_config.handlers:
+            handler.close()
+    finally:
+        sys.stderr.close()
+        sys.stderr = stderr
+    return {
+        "handlers": len(latencies),
+        "elapsed_s": elapsed,
+        "drain_s": drain,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": max(latencies, default=0.0) * 1000,
+        },
+        "loop_lag_ms": {
+            "p95": percentile(lags, 0.95) * 1000,
+            "max": max(lags, default=0.0) * 1000,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--handlers", type=int, default=20000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--format", choices=["text", "json"], default="text")
+    parser.add_argument("--max-bytes", type=int, default=1024 * 1024)
+    parser.add_argument("--backups", type=int, default=2)
+    parser.add_argument("--out", default="logging_results.json")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "args": vars(args),
+            "modes": {
+                "direct": run_mode(False, args, workdir),
+                "queue": run_mode(True, args, workdir),
+            },
+        }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    for mode, result in results["modes"].items():
+        latency, lag = result["latency_ms"], result["loop_lag_ms"]
+        print(f"{mode} ({args.format}): {result['handlers']} handlers in {result['elapsed_s']:.2f}s, "
+              f"p50 {latency['p50']:.3f}ms p95 {latency['p95']:.3f}ms p99 {latency['p99']:.3f}ms "
+              f"max {latency['max']:.2f}ms, loop lag p95 {lag['p95']:.2f}ms max {lag['max']:.2f}ms, "
+              f"drain {result['drain_s']:.2f}s")
+    print(f"Results written to {os.path.abspath(args.out)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""Cost of getting a GenerativeModel for each reply, by what the system instruction holds.
+
+A stream of replies to random users in random groups asks the Gemini backend for a model
+three ways: constructing one per reply, caching on the persona prompt formatted with the
+user's nickname and group, and caching on the persona prompt alone with the nickname and
+group sent as request content. Models are only constructed, no request is made, so no key
+is needed::
+
+    python bench/bench_model_cache.py --replies 20000 --users 500 --groups 20
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "app"), ROOT]
+
+import google.generativeai as genai  # noqa: E402
+
+from AI.backend import GeminiBackend, SAFETY_SETTINGS  # noqa: E402
+from AI.gemini import init_prompt_bot_statement  # noqa: E402
+
+MODEL = "gemini-1.5-flash"
+PERSONA = [{"t": "Bench", "n": "Bench",
+            "p": "You are {k}, a friendly member of the group {m}. You are chatting with {n}. " * 8}]
+
+
+def uncached(backend, nickname, group):
+    prompt = PERSONA[0]['p'].format(n=nickname, k=PERSONA[0]['n'], m=group)
+    return genai.GenerativeModel(model_name=MODEL, safety_settings=SAFETY_SETTINGS, system_instruction=prompt)
+
+
+def per_user_prompt(backend, nickname, group):
+    prompt = PERSONA[0]['p'].format(n=nickname, k=PERSONA[0]['n'], m=group)
+    return backend.get_model(MODEL, prompt)
+
+
+def persona_prompt(backend, nickname, group):
+    return backend.get_model(MODEL, init_prompt_bot_statement(PERSONA, 0))
+
+
+MODES = {
+    "uncached": uncached,
+    "per_user_prompt": per_user_prompt,
+    "persona_prompt": persona_prompt,
+}
+
+
+def run_mode(get, args):
+    rng = random.Random(args.seed)
+    replies = [(f"user{rng.randrange(args.users)}", f"Group {rng.randrange(args.groups)}")
+               for _ in range(args.replies)]
+    backend = GeminiBackend()
+    started = time.perf_counter()
+    for nickname, group in replies:
+        get(backend, nickname, group)
+    elapsed = time.perf_counter() - started
+    return {
+        "replies": len(replies),
+        "elapsed_s": elapsed,
+        "us_per_reply": elapsed / len(replies) * 1e6,
+        "cached": len(backend.models),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replies", type=int, default=20000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", default="model_cache_results.json")
+    args = parser.parse_args()
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "args": vars(args),
+        "modes": {mode: run_mode(get, args) for mode, get in MODES.items()},
+    }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    for mode, result in results["modes"].items():
+        print(f"{mode}: {result['replies']} replies in {result['elapsed_s']:.3f}s, "
+              f"{result['us_per_reply']:.2f}us per reply, {result['cached']} model(s) cached")
+    print(f"Results written to {os.path.abspath(args.out)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""Update-to-handler latency of polling against webhook delivery.
+
+A local fake Bot API server hands the same stream of synthetic updates to the bot
+either through long-polled getUpdates or by posting them to the bot's embedded
+webhook server. The latency is measured from the moment an update is available at
+the fake server until a handler sees it::
+
+    python bench/bench_webhook.py --updates 2000 --rate 200
+    python bench/bench_webhook.py --loop uvloop --out webhook_results.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, "app"), ROOT]
+
+from telegram.ext import Application, TypeHandler  # noqa: E402
+
+from fake_telegram import FakeBotApiServer, message_update  # noqa: E402
+from bench_handlers import percentile  # noqa: E402
+
+TOKEN = "1:bench"
+
+
+async def run_mode(mode, args):
+    server = FakeBotApiServer(args.api_port)
+    await server.start()
+
+    app = (Application.builder().token(TOKEN).base_url(server.base_url).concurrent_updates(True)
+           .connection_pool_size(args.max_connections + 8).build())
+    latencies = []
+
+    async def probe(update, context):
+        latencies.append(time.perf_counter() - server.pushed_at[update.update_id])
+
+    app.add_handler(TypeHandler(object, probe))
+
+    async with app:
+        if mode == "polling":
+            await app.updater.start_polling(poll_interval=0, timeout=10)
+        else:
+            await app.updater.start_webhook(
+                listen="127.0.0.1", port=args.webhook_port, url_path="hook", secret_token="bench-secret",
+                webhook_url=f"http://127.0.0.1:{args.webhook_port}/hook", max_connections=args.max_connections)
+        await app.start()
+
+        started = time.perf_counter()
+        interval = 1 / args.rate
+        pending = set()
+        for i in range(args.updates):
+            task = asyncio.create_task(server.push(message_update(-1, 2 + i % 50, f"update {i}")))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+            await asyncio.sleep(interval)
+        await asyncio.gather(*pending)
+        deadline = time.monotonic() + 30
+        while len(latencies) < args.updates and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+
+        await app.updater.stop()
+        await app.stop()
+    await server.stop()
+
+    return {
+        "updates": len(latencies),
+        "elapsed_s": elapsed,
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50) * 1000,
+            "p95": percentile(latencies, 0.95) * 1000,
+            "p99": percentile(latencies, 0.99) * 1000,
+            "max": max(latencies, default=0.0) * 1000,
+        },
+        "api_calls": dict(server.api.calls),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["polling", "webhook", "both"], default="both")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--rate", type=float, default=200, help="updates offered per second")
+    parser.add_argument("--max-connections", type=int, default=40)
+    parser.add_argument("--loop", choices=["asyncio", "uvloop"], default="asyncio")
+    parser.add_argument("--api-port", type=int, default=18081)
+    parser.add_argument("--webhook-port", type=int, default=18082)
+    parser.add_argument("--out", default="webhook_results.json")
+    args = parser.parse_args()
+
+    if args.loop == "uvloop":
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+    modes = ["polling", "webhook"] if args.mode == "both" else [args.mode]
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "args": vars(args),
+        "modes": {mode: asyncio.run(run_mode(mode, args)) for mode in modes},
+    }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    for mode, result in results["modes"].items():
+        latency = result["latency_ms"]
+        print(f"{mode} ({args.loop}): {result['updates']} updates, p50 {latency['p50']:.1f}ms "
+              f"p95 {latency['p95']:.1f}ms p99 {latency['p99']:.1f}ms max {latency['max']:.1f}ms")
+    print(f"Results written to {os.path.abspath(args.out)}")
+
+
+if __name__ == "__main__":
+    main()
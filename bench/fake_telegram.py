@@ -0,0 +1,193 @@
+"""In-process stand-ins for the Telegram Bot API and builders for synthetic updates."""
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+from urllib.parse import parse_qsl
+
+from telegram.request import BaseRequest
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+            "can_join_groups": True, "can_read_all_group_messages": True, "supports_inline_queries": False}
+
+
+class FakeBotApi(BaseRequest):
+    """Answers Bot API calls locally, optionally after ``latency`` seconds, and counts them per method."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self.message_ids = itertools.count(100000)
+        # (method, chat_id) -> time.perf_counter() when the first and the latest such call was answered
+        self.first_call = {}
+        self.last_call = {}
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit("/", 1)[-1]
+        self.calls[endpoint] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if "chat_id" in params:
+            key = (endpoint, int(params["chat_id"]))
+            self.last_call[key] = time.perf_counter()
+            self.first_call.setdefault(key, self.last_call[key])
+        return 200, json.dumps({"ok": True, "result": self.result(endpoint, params)}).encode()
+
+    def result(self, endpoint, params):
+        if endpoint == "getMe":
+            return BOT_USER
+        if endpoint == "getUpdates":
+            return []
+        if endpoint in ("sendMessage", "editMessageText"):
+            chat_id = int(params.get("chat_id", 0))
+            return {
+                "message_id": int(params.get("message_id") or next(self.message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+
+class FakeBotApiServer:
+    """A local HTTP server speaking enough of the Bot API for polling and webhook runs.
+
+    Updates passed to ``push`` are handed out by long-polled ``getUpdates`` calls, or, once
+    ``setWebhook`` was called, posted to the webhook with its secret token header.
+    ``pushed_at`` records when each update became available, by update id.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.api = FakeBotApi()
+        self.updates = []
+        self.arrived = asyncio.Event()
+        self.webhook = None
+        self.secret = None
+        self.pushed_at = {}
+        self.server = None
+        self.client = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.port}/bot"
+
+    async def start(self):
+        from tornado.httpclient import AsyncHTTPClient
+        from tornado.web import Application, RequestHandler
+
+        server = self
+
+        class Endpoint(RequestHandler):
+            async def post(self, token, endpoint):
+                body = self.request.body.decode() if self.request.body else ""
+                if self.request.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(body or "{}")
+                else:
+                    params = dict(parse_qsl(body))
+                result = await server.handle(endpoint, params)
+                self.set_header("Content-Type", "application/json")
+                self.write(json.dumps({"ok": True, "result": result}))
+
+            get = post
+
+        self.server = Application([(r"/bot([^/]+)/(\w+)", Endpoint)]).listen(self.port, "127.0.0.1")
+        self.client = AsyncHTTPClient(max_clients=100)
+
+    async def stop(self):
+        # Let a long poll left behind by the stopped updater return before the loop closes
+        self.arrived.set()
+        await asyncio.sleep(0)
+        self.server.stop()
+        self.client.close()
+
+    async def handle(self, endpoint, params):
+        self.api.calls[endpoint] += 1
+        if endpoint == "setWebhook":
+            self.webhook = params["url"]
+            self.secret = params.get("secret_token")
+            return True
+        if endpoint == "deleteWebhook":
+            self.webhook = None
+            return True
+        if endpoint == "getUpdates":
+            return await self.get_updates(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        return self.api.result(endpoint, params)
+
+    async def get_updates(self, offset, timeout):
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.arrived.clear()
+            try:
+                await asyncio.wait_for(self.arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:100]
+
+    async def push(self, update):
+        self.pushed_at[update["update_id"]] = time.perf_counter()
+        if self.webhook is None:
+            self.updates.append(update)
+            self.arrived.set()
+            return
+        headers = {"Content-Type": "application/json"}
+        if self.secret:
+            headers["X-Telegram-Bot-Api-Secret-Token"] = self.secret
+        await self.client.fetch(self.webhook, method="POST", body=json.dumps(update), headers=headers)
+
+
+update_ids = itertools.count(1)
+message_ids = itertools.count(1)
+
+
+def user(user_id):
+    return {"id": user_id, "is_bot": False, "first_name": f"Player{user_id}", "username": f"player{user_id}"}
+
+
+def chat(chat_id):
+    return {"id": chat_id, "type": "supergroup", "title": f"Group {chat_id}"}
+
+
+def message_update(chat_id, user_id, text, reply_to_bot=False):
+    message = {
+        "message_id": next(message_ids),
+        "date": int(time.time()),
+        "chat": chat(chat_id),
+        "from": user(user_id),
+        "text": text,
+    }
+    if text.startswith("/"):
+        command = text.split()[0]
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+    if reply_to_bot:
+        message["reply_to_message"] = {"message_id": next(message_ids), "date": int(time.time()),
+                                       "chat": chat(chat_id), "from": BOT_USER, "text": "earlier reply"}
+    return {"update_id": next(update_ids), "message": message}
+
+
+def callback_update(chat_id, user_id, data, message_id=1):
+    return {
+        "update_id": next(update_ids),
+        "callback_query": {
+            "id": str(next(update_ids)),
+            "from": user(user_id),
+            "chat_instance": str(chat_id),
+            "data": data,
+            "message": {"message_id": message_id, "date": int(time.time()), "chat": chat(chat_id),
+                        "from": BOT_USER, "text": "..."},
+        },
+    }